@@ -1,15 +1,44 @@
 from fastapi import FastAPI, Request, HTTPException, Depends
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi.responses import JSONResponse, HTMLResponse, RedirectResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from fastapi.staticfiles import StaticFiles
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+import asyncio
+import bisect
 import secrets
+import sys
 import uuid
 import time
 import json
 import redis
 import os
+import re
+import queue
+import hashlib
+import zlib
+import atexit
 import logging
+import logging.handlers
+import threading
+import contextvars
+import http.client
+import urllib.error
 import urllib.parse
+import urllib.request
+import gzip
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = FastAPI(title="PACS Auth Service", description="Authentication and token management for PACS")
 security = HTTPBasic()
@@ -21,12 +50,49 @@ app.mount("/static", StaticFiles(directory="/app/static"), name="static")
 REDIS_HOST = os.getenv("REDIS_HOST", "redis")
 REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
 REDIS_DB = int(os.getenv("REDIS_DB", "0"))
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "2"))      # seconds
+# Token shards as "host:port/db,host:port/db" (empty = tokens stored on REDIS_HOST only).
+# Indexes, change tracking and audit keys always stay on REDIS_HOST.
+REDIS_SHARDS = [spec.strip() for spec in os.getenv("REDIS_SHARDS", "").split(",") if spec.strip()]
+REDIS_SHARD_VNODES = int(os.getenv("REDIS_SHARD_VNODES", "160"))
+
+# Health / warm start configuration
+READINESS_REDIS_MAX_LATENCY_MS = float(os.getenv("READINESS_REDIS_MAX_LATENCY_MS", "50"))
+WARMUP_REDIS_CONNECTIONS = int(os.getenv("WARMUP_REDIS_CONNECTIONS", "4"))
+
+# Change tracking for delta sync of the token list
+TOKENS_VERSION_KEY = "tokens:version"         # Monotonic change counter
+TOKENS_CHANGES_KEY = "tokens:changes"         # Token ID -> version of its last change
+TOKENS_CHANGES_FLOOR_KEY = "tokens:changes:floor"  # Older versions were trimmed
+TOKENS_EXPIRY_KEY = "tokens:expiry"           # Token ID -> expires_at
+TOKENS_IDEMPOTENCY_PREFIX = "tokens:idem:"     # Hash of (creator, type, request Id or resources) -> token ID
+TOKEN_CHANGES_RETENTION = int(os.getenv("TOKEN_CHANGES_RETENTION", "100000"))  # versions kept
+
+# Per-token access analytics (constant space per token, written by a background thread)
+ANALYTICS_ENABLED = os.getenv("ANALYTICS_ENABLED", "true").lower() == "true"
+ANALYTICS_PREFIX = "tokenstats:"               # tokenstats:{id}:hits|clients|agents
+ANALYTICS_BUCKET_SECONDS = int(os.getenv("ANALYTICS_BUCKET_SECONDS", "3600"))
+ANALYTICS_BUCKETS = int(os.getenv("ANALYTICS_BUCKETS", "168"))          # buckets kept per token (1 week of hours)
+ANALYTICS_QUEUE_SIZE = int(os.getenv("ANALYTICS_QUEUE_SIZE", "10000"))
 
 # Token configuration
 DEFAULT_TOKEN_MAX_USES = int(os.getenv("DEFAULT_TOKEN_MAX_USES", "50"))
 DEFAULT_TOKEN_VALIDITY_SECONDS = int(os.getenv("DEFAULT_TOKEN_VALIDITY_SECONDS", str(7 * 24 * 3600)))  # 7 days
+TOKEN_REUSE_ENABLED = os.getenv("TOKEN_REUSE_ENABLED", "true").lower() == "true"
+TOKEN_REUSE_MIN_REMAINING_SECONDS = int(os.getenv("TOKEN_REUSE_MIN_REMAINING_SECONDS", "3600"))  # Never hand out a token about to expire
 CACHE_VALIDITY_USER_SESSION = int(os.getenv("CACHE_VALIDITY_USER_SESSION", "300"))  # 5 minutes  
 CACHE_VALIDITY_SHARE_TOKEN = int(os.getenv("CACHE_VALIDITY_SHARE_TOKEN", "60"))    # 1 minute
+# Share token decisions are cached longer while the token has life and uses left, within these bounds
+CACHE_VALIDITY_SHARE_TOKEN_MAX = int(os.getenv("CACHE_VALIDITY_SHARE_TOKEN_MAX", "300"))  # 5 minutes
+TOKEN_REVOCATION_MAX_DELAY = int(os.getenv("TOKEN_REVOCATION_MAX_DELAY", "60"))  # revoked tokens honored by Orthanc at most this long; raise to let the bounds above apply
+CACHE_VALIDITY_LOW_USES = float(os.getenv("CACHE_VALIDITY_LOW_USES", "0.1"))  # share of uses left below which the base validity applies
+CACHE_VALIDITY_DENIED = int(os.getenv("CACHE_VALIDITY_DENIED", "5"))  # denials are cached briefly
+
+# Token API responses (admin token manager)
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESSION_MIN_BYTES", "1024"))
+RESPONSE_GZIP_LEVEL = int(os.getenv("RESPONSE_GZIP_LEVEL", "5"))
+RESPONSE_BROTLI_QUALITY = int(os.getenv("RESPONSE_BROTLI_QUALITY", "4"))
 
 # Audit configuration
 AUDIT_RETENTION_DAYS = int(os.getenv("AUDIT_RETENTION_DAYS", "90"))  # 90 days
@@ -38,23 +104,155 @@ UI_MESSAGES = {
     "EXPIRED_TOKEN": os.getenv("UI_MSG_EXPIRED_TOKEN", "Ce lien de partage n'est plus valide."),
     "NO_STUDY": os.getenv("UI_MSG_NO_STUDY", "Aucune étude associée à ce token."),
     "INVALID_STUDY": os.getenv("UI_MSG_INVALID_STUDY", "Identifiant d'étude manquant."),
-    "USAGE_LIMIT": os.getenv("UI_MSG_USAGE_LIMIT", "Ce lien de partage a atteint sa limite d'utilisation.")
+    "USAGE_LIMIT": os.getenv("UI_MSG_USAGE_LIMIT", "Ce lien de partage a atteint sa limite d'utilisation."),
+    "DOWNLOAD_BUSY": os.getenv("UI_MSG_DOWNLOAD_BUSY", "Trop de téléchargements en cours, veuillez réessayer dans quelques instants."),
+    "DOWNLOAD_FAILED": os.getenv("UI_MSG_DOWNLOAD_FAILED", "L'étude n'a pas pu être récupérée.")
 }
 
 # Configuration du logging
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")           # json | text
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Share of requests whose DEBUG/INFO records are kept, per path: "/tokens/validate=0.01,/share/=0.5"
+LOG_SAMPLE_RATES = {
+    path.strip(): float(rate)
+    for path, _, rate in (item.partition("=") for item in os.getenv("LOG_SAMPLE_RATES", "").split(",") if "=" in item)
+}
+
+# (request ID, path) of the request being served, set by TracingMiddleware
+current_request = contextvars.ContextVar("current_request", default=("", ""))
+
+class TextLogFormatter(logging.Formatter):
+    """Classic text lines, structured fields appended as JSON"""
+
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        if record.request_id:
+            line += f" [request_id={record.request_id}]"
+        return f"{line} {json.dumps(fields, default=str)}" if fields else line
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per record"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        if record.request_id:
+            entry["request_id"] = record.request_id
+            entry["path"] = record.path
+        fields = getattr(record, "fields", None)
+        for key, value in (fields or {}).items():
+            entry.setdefault(key, value)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class SampledQueueHandler(logging.handlers.QueueHandler):
+    """Hand records to the log thread as is: messages are formatted there, never on the request path"""
+
+    def prepare(self, record):
+        record.request_id, record.path = current_request.get()
+        return record
+
+    def filter(self, record):
+        # Sample whole requests: every record of a kept request is kept
+        rate = LOG_SAMPLE_RATES.get(current_request.get()[1])
+        if rate is not None and record.levelno < logging.WARNING:
+            request_id = current_request.get()[0]
+            if zlib.crc32(request_id.encode()) % 10000 >= rate * 10000:
+                return False
+        return super().filter(record)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass  # Drop records rather than slow down authorization decisions
+
+log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+log_stream_handler = logging.StreamHandler()
+log_stream_handler.setFormatter(
+    JsonLogFormatter() if LOG_FORMAT == "json"
+    else TextLogFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+)
+log_listener = logging.handlers.QueueListener(log_queue, log_stream_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+log_queue_handler = SampledQueueHandler(log_queue)
 logging.basicConfig(
     level=getattr(logging, LOG_LEVEL.upper()),
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler()
-    ]
+    handlers=[log_queue_handler]
 )
+# The uvicorn CLI gives its loggers synchronous stream handlers before importing the app: queue them too
+# (uvicorn.error propagates to uvicorn)
+for uvicorn_logger_name in ("uvicorn", "uvicorn.access"):
+    logging.getLogger(uvicorn_logger_name).handlers = [log_queue_handler]
+    logging.getLogger(uvicorn_logger_name).propagate = False
 logger = logging.getLogger("auth-service")
 
-# Configuration CDN
+# Configuration CDN (fallback when Font Awesome is not bundled in the image)
 FONT_AWESOME_CDN = os.getenv("FONT_AWESOME_CDN", "https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.5.1/css/all.min.css")
 
+# Share landing page: "direct" = HTTP 302 to OHIF, "page" = HTML redirect page
+SHARE_REDIRECT_MODE = os.getenv("SHARE_REDIRECT_MODE", "page").lower()
+
+# Self-hosted assets for public share pages (served with content-hashed names)
+SHARE_ASSETS_DIRS = ["/app/vendor/fontawesome"]
+SHARE_ASSETS_URL = "/share/static"
+ASSET_CACHE_CONTROL_HASHED = "public, max-age=31536000, immutable"
+ASSET_CACHE_CONTROL_PLAIN = "public, max-age=86400"
+
+class HashedStaticFiles(StaticFiles):
+    """Static files also reachable under content-hashed names (e.g. all.min.3f2a9c1b7d4e.css).
+
+    Hashed names change whenever the content does, so they are served as
+    immutable; plain names (e.g. fonts referenced from CSS) get a shorter cache.
+    """
+
+    def __init__(self, directories: list, **kwargs):
+        directories = [d for d in directories if os.path.isdir(d)]
+        super().__init__(directory=directories[0] if directories else None,
+                         check_dir=False, **kwargs)
+        self.all_directories = directories
+        self.hashed_to_original = {}
+        self.original_to_hashed = {}
+        for directory in directories:
+            for root, _, files in os.walk(directory):
+                for filename in files:
+                    path = os.path.relpath(os.path.join(root, filename), directory)
+                    if path in self.original_to_hashed:
+                        continue  # First directory wins, as in lookup_path()
+                    with open(os.path.join(root, filename), "rb") as f:
+                        digest = hashlib.sha256(f.read()).hexdigest()[:12]
+                    base, ext = os.path.splitext(path)
+                    hashed = f"{base}.{digest}{ext}"
+                    self.hashed_to_original[hashed] = path
+                    self.original_to_hashed[path] = hashed
+
+    def url_for(self, path: str):
+        """Public URL of an asset under its hashed name, or None if not bundled"""
+        hashed = self.original_to_hashed.get(path)
+        return f"{SHARE_ASSETS_URL}/{hashed}" if hashed else None
+
+    async def get_response(self, path: str, scope):
+        original = self.hashed_to_original.get(path)
+        response = await super().get_response(original or path, scope)
+        if response.status_code in (200, 304):
+            response.headers["Cache-Control"] = ASSET_CACHE_CONTROL_HASHED if original else ASSET_CACHE_CONTROL_PLAIN
+        return response
+
+share_assets = HashedStaticFiles(SHARE_ASSETS_DIRS)
+
+# Font Awesome from the image when bundled, otherwise from the CDN
+FONT_AWESOME_URL = share_assets.url_for("css/all.min.css") or FONT_AWESOME_CDN
+
+app.mount(SHARE_ASSETS_URL, share_assets, name="share-static")
+
 # Configuration JavaScript
 JS_CONFIG = {
     "REFRESH_INTERVAL": int(os.getenv("JS_REFRESH_INTERVAL", "30000")),
@@ -72,25 +270,543 @@ USER_ROLES = {
     "external": "external-role"
 }
 
-# Redis connection
-redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True)
+# Roles known by the permission checks (exposed to the Authorization plugin)
+AVAILABLE_ROLES = ["admin-role", "doctor-role", "external-role"]
+
+# Templates rendered by the service (preloaded at startup)
+TEMPLATES_DIR = "/app/templates"
+REQUIRED_TEMPLATES = ["error.html", "access_denied.html", "redirect.html"]
+template_cache = {}
+
+# Request tracing (Zipkin v2 JSON spans)
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "false").lower() == "true"
+TRACE_EXPORT_FILE = os.getenv("TRACE_EXPORT_FILE", "")          # JSON lines, one trace per line
+TRACE_COLLECTOR_URL = os.getenv("TRACE_COLLECTOR_URL", "")      # e.g. http://jaeger:9411/api/v2/spans
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "1000"))
+SLOW_VALIDATION_THRESHOLD_MS = float(os.getenv("SLOW_VALIDATION_THRESHOLD_MS", "250"))  # 0 = disabled
+SERVICE_NAME = "auth-service"
+REQUEST_ID_HEADER = "X-Request-ID"
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+TRACE_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+SLOW_LOG_PATH = "/tokens/validate"
+
+def trace_recorded(path: str) -> bool:
+    """Spans are recorded when they are exported or needed for the slow-request log"""
+    return TRACING_ENABLED or (SLOW_VALIDATION_THRESHOLD_MS > 0 and path == SLOW_LOG_PATH)
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+trace_queue = queue.Queue(maxsize=TRACE_QUEUE_SIZE)
+
+class Trace:
+    """Spans recorded for one request"""
+
+    __slots__ = ("request_id", "trace_id", "spans", "stack")
+
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        # nginx $request_id is already a 128-bit hex id and can be reused as trace id
+        self.trace_id = request_id if TRACE_ID_PATTERN.match(request_id) else uuid.uuid4().hex
+        self.spans = []
+        self.stack = []
+
+@contextmanager
+def trace_span(name: str, kind: str = None, **tags):
+    """Record a span in the current request trace (no-op outside a traced request)"""
+    trace = current_trace.get()
+    if trace is None:
+        yield None
+        return
+    span = {
+        "traceId": trace.trace_id,
+        "id": uuid.uuid4().hex[:16],
+        "name": name,
+        "timestamp": int(time.time() * 1_000_000),
+        "localEndpoint": {"serviceName": SERVICE_NAME},
+        "tags": {key: str(value) for key, value in tags.items()}
+    }
+    if kind:
+        span["kind"] = kind
+    if trace.stack:
+        span["parentId"] = trace.stack[-1]["id"]
+    trace.stack.append(span)
+    start = time.perf_counter()
+    try:
+        yield span
+    except Exception as e:
+        span["tags"]["error"] = str(e) or type(e).__name__
+        raise
+    finally:
+        span["duration"] = max(int((time.perf_counter() - start) * 1_000_000), 1)
+        trace.stack.pop()
+        trace.spans.append(span)
+
+def current_request_id() -> str:
+    """Request ID of the request being served (empty outside a request)"""
+    return current_request.get()[0]
+
+def export_trace(trace: Trace):
+    """Hand a finished trace to the export thread without blocking the request"""
+    try:
+        trace_queue.put_nowait(trace.spans)
+    except queue.Full:
+        pass  # Drop traces rather than slow down authorization decisions
+
+def trace_export_worker():
+    """Write finished traces to TRACE_EXPORT_FILE and/or POST them to TRACE_COLLECTOR_URL"""
+    while True:
+        batch = [trace_queue.get()]
+        while len(batch) < 100:
+            try:
+                batch.append(trace_queue.get_nowait())
+            except queue.Empty:
+                break
+        if TRACE_EXPORT_FILE:
+            try:
+                with open(TRACE_EXPORT_FILE, "a", encoding="utf-8") as f:
+                    for spans in batch:
+                        f.write(json.dumps(spans) + "\n")
+            except OSError as e:
+                logger.warning("Trace export to file failed: %s", e)
+        if TRACE_COLLECTOR_URL:
+            payload = json.dumps([span for spans in batch for span in spans]).encode()
+            collector_request = urllib.request.Request(
+                TRACE_COLLECTOR_URL, data=payload, headers={"Content-Type": "application/json"}
+            )
+            try:
+                urllib.request.urlopen(collector_request, timeout=5).close()
+            except OSError as e:
+                logger.warning("Trace export to collector failed: %s", e)
+
+def log_slow_request(trace: Trace, root: dict):
+    """Log the span breakdown of a request that exceeded the slow threshold"""
+    breakdown = [
+        {"name": span["name"], "ms": round(span["duration"] / 1000, 2)}
+        for span in sorted(trace.spans, key=lambda span: span["timestamp"])
+        if span is not root
+    ]
+    logger.warning("Slow request", extra={"fields": {
+        "request_id": trace.request_id,
+        "trace_id": trace.trace_id,
+        "name": root["name"],
+        "total_ms": round(root["duration"] / 1000, 2),
+        "spans": breakdown
+    }})
+
+class TracingMiddleware:
+    """Accept or create a request ID, echo it back and trace the request"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = ""
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")
+                break
+        if not REQUEST_ID_PATTERN.match(request_id):
+            request_id = uuid.uuid4().hex
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-request-id", request_id.encode("latin-1"))
+                ]
+            await send(message)
+
+        trace = Trace(request_id) if trace_recorded(scope["path"]) else None
+        context_token = current_trace.set(trace)
+        request_token = current_request.set((request_id, scope["path"]))
+        try:
+            if trace is None:
+                await self.app(scope, receive, send_with_request_id)
+                return
+            with trace_span(f"{scope['method']} {scope['path']}", kind="SERVER",
+                            **{"http.method": scope["method"], "http.path": scope["path"],
+                               "request.id": request_id}) as root:
+                await self.app(scope, receive, send_with_request_id)
+                endpoint = scope.get("endpoint")
+                if endpoint is not None:
+                    root["name"] = f"{scope['method']} {endpoint.__name__}"
+        finally:
+            current_trace.reset(context_token)
+            current_request.reset(request_token)
+            if trace is not None:
+                self.finish(trace, root, scope)
+
+    @staticmethod
+    def finish(trace: Trace, root: dict, scope):
+        if TRACING_ENABLED:
+            export_trace(trace)
+        if (SLOW_VALIDATION_THRESHOLD_MS > 0 and scope.get("path") == SLOW_LOG_PATH
+                and root["duration"] > SLOW_VALIDATION_THRESHOLD_MS * 1000):
+            log_slow_request(trace, root)
+
+app.add_middleware(TracingMiddleware)
+
+class TracedPipeline(redis.client.Pipeline):
+    """Redis pipeline recording one span per execute()"""
+
+    def execute(self, raise_on_error=True):
+        with trace_span("redis PIPELINE", kind="CLIENT", **{"db.commands": len(self.command_stack)}):
+            return super().execute(raise_on_error)
+
+class TracedRedis(redis.Redis):
+    """Redis client recording a span around each command"""
+
+    def execute_command(self, *args, **options):
+        with trace_span(f"redis {args[0]}", kind="CLIENT"):
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return TracedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+# Study prewarming (asks Orthanc for DICOMweb metadata when a share link is opened)
+ORTHANC_URL = os.getenv("ORTHANC_URL", "http://orthanc:8042").rstrip("/")
+PREWARM_ENABLED = os.getenv("PREWARM_ENABLED", "true").lower() == "true"
+PREWARM_WORKERS = int(os.getenv("PREWARM_WORKERS", "2"))
+PREWARM_QUEUE_SIZE = int(os.getenv("PREWARM_QUEUE_SIZE", "20"))
+PREWARM_DEDUP_SECONDS = int(os.getenv("PREWARM_DEDUP_SECONDS", "300"))
+PREWARM_MAX_INSTANCES = int(os.getenv("PREWARM_MAX_INSTANCES", "50"))
+PREWARM_TIMEOUT = float(os.getenv("PREWARM_TIMEOUT", "30"))           # seconds per Orthanc request
+# Session token (a USER_ROLES key) used towards Orthanc for prewarming and downloads, so these requests are not counted as share token uses
+ORTHANC_SERVICE_TOKEN = os.getenv("ORTHANC_SERVICE_TOKEN", "external")
+
+prewarm_executor = ThreadPoolExecutor(max_workers=PREWARM_WORKERS, thread_name_prefix="prewarm")
+prewarm_lock = threading.Lock()
+prewarm_pending = set()         # Studies queued or being warmed
+prewarm_recent = {}             # Study UID -> time of last completed warm-up
+
+def orthanc_get(path: str, request_id: str = "", accept: str = "application/dicom+json"):
+    """GET an Orthanc resource with the service token, discarding the body; returns parsed JSON if asked"""
+    headers = {"Accept": accept, "auth-token": ORTHANC_SERVICE_TOKEN}
+    if request_id:
+        headers[REQUEST_ID_HEADER] = request_id
+    orthanc_request = urllib.request.Request(f"{ORTHANC_URL}{path}", headers=headers)
+    with urllib.request.urlopen(orthanc_request, timeout=PREWARM_TIMEOUT) as response:
+        if accept == "application/dicom+json":
+            return json.load(response)
+        while response.read(65536):
+            pass
+    return None
+
+def dicom_value(instance: dict, tag: str, default=None):
+    """First value of a DICOM JSON attribute"""
+    values = instance.get(tag, {}).get("Value") or []
+    return values[0] if values else default
+
+def prewarm_study(study_uid: str, request_id: str = ""):
+    """Load study metadata, then the first series' metadata and frames, so Orthanc has them cached"""
+    start = time.perf_counter()
+    quoted_study = urllib.parse.quote(study_uid, safe="")
+    try:
+        instances = orthanc_get(f"/dicom-web/studies/{quoted_study}/metadata", request_id) or []
+        
+        # First series as displayed: lowest series number
+        series = {}
+        for instance in instances:
+            series_uid = dicom_value(instance, "0020000E")
+            if series_uid:
+                series.setdefault(series_uid, []).append(instance)
+        if series:
+            first_series_uid = min(series, key=lambda uid: (dicom_value(series[uid][0], "00200011", 0) or 0, uid))
+            quoted_series = urllib.parse.quote(first_series_uid, safe="")
+            series_path = f"/dicom-web/studies/{quoted_study}/series/{quoted_series}"
+            orthanc_get(f"{series_path}/metadata", request_id)
+            
+            first_instances = sorted(series[first_series_uid], key=lambda i: dicom_value(i, "00200013", 0) or 0)
+            for instance in first_instances[:PREWARM_MAX_INSTANCES]:
+                sop_uid = dicom_value(instance, "00080018")
+                if sop_uid:
+                    quoted_sop = urllib.parse.quote(sop_uid, safe="")
+                    orthanc_get(f"{series_path}/instances/{quoted_sop}/frames/1", request_id,
+                                accept="multipart/related; type=application/octet-stream; transfer-syntax=*")
+        
+        logger.info("Prewarmed study %s in %.2fs", study_uid, time.perf_counter() - start)
+    except (OSError, ValueError) as e:
+        logger.warning("Prewarm failed for study %s: %s", study_uid, e)
+    finally:
+        with prewarm_lock:
+            prewarm_pending.discard(study_uid)
+            prewarm_recent[study_uid] = time.time()
+
+def enqueue_study_prewarm(study_uid: str) -> bool:
+    """Queue a study warm-up unless it is already queued, recently warmed or the pool is full"""
+    if not PREWARM_ENABLED:
+        return False
+    now = time.time()
+    with prewarm_lock:
+        if study_uid in prewarm_pending:
+            return False
+        if now - prewarm_recent.get(study_uid, 0) < PREWARM_DEDUP_SECONDS:
+            return False
+        if len(prewarm_pending) >= PREWARM_QUEUE_SIZE:
+            logger.debug("Prewarm queue full, skipping study %s", study_uid)
+            return False
+        # Forget old completions so the dedup map stays bounded
+        for uid in [uid for uid, done in prewarm_recent.items() if now - done >= PREWARM_DEDUP_SECONDS]:
+            del prewarm_recent[uid]
+        prewarm_pending.add(study_uid)
+    prewarm_executor.submit(prewarm_study, study_uid, current_request_id())
+    return True
+
+# Study downloads for share-token holders (streamed from Orthanc, never buffered)
+DOWNLOAD_ENABLED = os.getenv("DOWNLOAD_ENABLED", "true").lower() == "true"
+DOWNLOAD_MAX_CONCURRENT = int(os.getenv("DOWNLOAD_MAX_CONCURRENT", "4"))
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", "262144"))      # bytes
+DOWNLOAD_TIMEOUT = float(os.getenv("DOWNLOAD_TIMEOUT", "120"))            # seconds without data from Orthanc
+download_slots = threading.BoundedSemaphore(DOWNLOAD_MAX_CONCURRENT)
+
+class StudyDownload:
+    """Orthanc study archive relayed chunk by chunk, holding one download slot until closed"""
+
+    def __init__(self, orthanc_id: str, request_id: str = ""):
+        headers = {"auth-token": ORTHANC_SERVICE_TOKEN}
+        if request_id:
+            headers[REQUEST_ID_HEADER] = request_id
+        quoted_id = urllib.parse.quote(orthanc_id, safe="")
+        archive_request = urllib.request.Request(f"{ORTHANC_URL}/studies/{quoted_id}/archive", headers=headers)
+        self.response = urllib.request.urlopen(archive_request, timeout=DOWNLOAD_TIMEOUT)
+        self.closed = False
+        self.lock = threading.Lock()
+
+    @property
+    def content_length(self):
+        return self.response.headers.get("Content-Length")
+
+    def chunks(self):
+        # Sync generator: the response pulls the next chunk only once the previous one was sent
+        try:
+            while True:
+                chunk = self.response.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        """Release the Orthanc connection and the download slot (safe to call twice)"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        self.response.close()
+        download_slots.release()
+
+def lookup_orthanc_study(study_uid: str) -> str:
+    """Orthanc ID of a study from its StudyInstanceUID"""
+    lookup_request = urllib.request.Request(
+        f"{ORTHANC_URL}/tools/lookup",
+        data=study_uid.encode(),
+        headers={"auth-token": ORTHANC_SERVICE_TOKEN},
+        method="POST"
+    )
+    with urllib.request.urlopen(lookup_request, timeout=PREWARM_TIMEOUT) as response:
+        matches = json.load(response)
+    return next((match["ID"] for match in matches if match.get("Type") == "Study"), "")
+
+# Sampling profiler (admin endpoint, idle unless a profile is running)
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "60"))
+PROFILE_DEFAULT_INTERVAL_MS = float(os.getenv("PROFILE_DEFAULT_INTERVAL_MS", "5"))
+profile_lock = threading.Lock()
+
+def sample_stacks(stop: threading.Event, interval: float, counts: dict):
+    """Sample every other thread's Python stack until stop is set"""
+    own_id = threading.get_ident()
+    thread_names = {}
+    while not stop.wait(interval):
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            name = thread_names.get(thread_id)
+            if name is None:
+                thread_names.update((thread.ident, thread.name) for thread in threading.enumerate())
+                name = thread_names.setdefault(thread_id, str(thread_id))
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            stack.append(name)
+            key = ";".join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+
+def create_redis_client(host: str, port: int, db: int) -> TracedRedis:
+    """Redis client with its own connection pool (explicit so it can be warmed at startup)"""
+    pool = redis.ConnectionPool(
+        host=host,
+        port=port,
+        db=db,
+        decode_responses=True,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
+        socket_timeout=REDIS_SOCKET_TIMEOUT
+    )
+    return TracedRedis(connection_pool=pool)
+
+def parse_redis_node(spec: str) -> tuple:
+    """Parse "host[:port][/db]" into (host, port, db)"""
+    address, _, db = spec.partition("/")
+    host, _, port = address.partition(":")
+    return host, int(port or 6379), int(db or 0)
+
+class ShardRing:
+    """Consistent hash ring mapping token IDs to Redis nodes"""
+
+    def __init__(self, nodes: dict, vnodes: int = REDIS_SHARD_VNODES):
+        self.nodes = nodes
+        points = sorted(
+            (self.hash(f"{name}#{i}"), name) for name in nodes for i in range(vnodes)
+        )
+        self.hashes = [point for point, _ in points]
+        self.owners = [name for _, name in points]
+
+    @staticmethod
+    def hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+    def node_for(self, key: str) -> str:
+        index = bisect.bisect(self.hashes, self.hash(key)) % len(self.hashes)
+        return self.owners[index]
+
+    def client_for(self, key: str):
+        return self.nodes[self.node_for(key)]
+
+# Redis connection (indexes, change tracking, audit; also the token store when not sharded)
+REDIS_PRIMARY_NODE = f"{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}"
+redis_client = create_redis_client(REDIS_HOST, REDIS_PORT, REDIS_DB)
+redis_pool = redis_client.connection_pool
+
+def build_shard_ring(specs: list):
+    """Ring over the given node specs, reusing the primary client when it is one of them"""
+    nodes = {}
+    for spec in specs:
+        host, port, db = parse_redis_node(spec)
+        name = f"{host}:{port}/{db}"
+        nodes[name] = redis_client if name == REDIS_PRIMARY_NODE else create_redis_client(host, port, db)
+    return ShardRing(nodes) if nodes else None
+
+token_ring = build_shard_ring(REDIS_SHARDS)
+
+def token_shard(token: str):
+    """Redis client holding a token"""
+    return token_ring.client_for(token) if token_ring else redis_client
+
+def token_shards() -> dict:
+    """All Redis nodes holding tokens, by name"""
+    return token_ring.nodes if token_ring else {REDIS_PRIMARY_NODE: redis_client}
+
+def scan_tokens(client, batch_size: int = 100):
+    """Yield (token_id, token_data) for every token on a Redis node, one MGET per scan batch"""
+    cursor = 0
+    while True:
+        cursor, keys = client.scan(cursor, match="token:*", count=batch_size)
+        if keys:
+            for key, data in zip(keys, client.mget(keys)):
+                if data:
+                    yield key[len("token:"):], json.loads(data)
+        if cursor == 0:
+            break
+
+def scan_all_tokens():
+    """Yield (token_id, token_data) across all shards"""
+    for client in token_shards().values():
+        yield from scan_tokens(client)
+
+def get_tokens(token_ids: list) -> list:
+    """Fetch several tokens (raw JSON or None) with one pipeline per shard"""
+    by_shard = {}
+    for index, token_id in enumerate(token_ids):
+        shard = token_shard(token_id)
+        by_shard.setdefault(id(shard), (shard, []))[1].append(index)
+    values = [None] * len(token_ids)
+    for client, indexes in by_shard.values():
+        pipe = client.pipeline(transaction=False)
+        for index in indexes:
+            pipe.get(f"token:{token_ids[index]}")
+        for index, value in zip(indexes, pipe.execute()):
+            values[index] = value
+    return values
+
+# Bump the change version once per token and remember it for delta sync
+RECORD_CHANGES_SCRIPT = redis_client.register_script("""
+local version = 0
+for i = 2, #ARGV do
+    version = redis.call('INCR', KEYS[1])
+    redis.call('ZADD', KEYS[2], version, ARGV[i])
+end
+local floor = version - tonumber(ARGV[1])
+if floor > 0 then
+    redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', floor)
+    redis.call('SET', KEYS[3], floor)
+end
+return version
+""")
+
+def record_token_changes(tokens: list, client=None):
+    """Record that tokens were created, updated or removed"""
+    RECORD_CHANGES_SCRIPT(
+        keys=[TOKENS_VERSION_KEY, TOKENS_CHANGES_KEY, TOKENS_CHANGES_FLOOR_KEY],
+        args=[TOKEN_CHANGES_RETENTION, *tokens],
+        client=client or redis_client
+    )
+
+def get_change_version() -> int:
+    """Current token change version"""
+    return int(redis_client.get(TOKENS_VERSION_KEY) or 0)
+
+def sweep_expired_tokens():
+    """Record tokens that Redis expired on its own as removed"""
+    expired = redis_client.zrangebyscore(TOKENS_EXPIRY_KEY, "-inf", time.time())
+    if expired:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.zrem(TOKENS_EXPIRY_KEY, *expired)
+        record_token_changes(expired, client=pipe)
+        pipe.execute()
+
+def write_token(token: str, token_data: dict, expiration_time: int):
+    """Write token data and record the change (one round trip when not sharded)"""
+    shard = token_shard(token)
+    pipe = redis_client.pipeline(transaction=False)
+    if shard is redis_client:
+        pipe.setex(f"token:{token}", expiration_time, json.dumps(token_data))
+    else:
+        shard.setex(f"token:{token}", expiration_time, json.dumps(token_data))
+    pipe.zadd(TOKENS_EXPIRY_KEY, {token: token_data["expires_at"]})
+    record_token_changes([token], client=pipe)
+    pipe.execute()
 
 def store_token(token: str, token_data: dict):
     """Store token in Redis with expiration"""
     expiration_time = int(token_data["expires_at"] - time.time())
     if expiration_time > 0:
-        redis_client.setex(f"token:{token}", expiration_time, json.dumps(token_data))
+        write_token(token, token_data, expiration_time)
 
 def get_token(token: str) -> dict:
     """Get token from Redis"""
-    data = redis_client.get(f"token:{token}")
+    data = token_shard(token).get(f"token:{token}")
     if data:
         return json.loads(data)
     return None
 
 def delete_token(token: str):
     """Delete token from Redis"""
-    redis_client.delete(f"token:{token}")
+    shard = token_shard(token)
+    pipe = redis_client.pipeline(transaction=False)
+    if shard is redis_client:
+        pipe.delete(f"token:{token}")
+    else:
+        shard.delete(f"token:{token}")
+    pipe.zrem(TOKENS_EXPIRY_KEY, token)
+    pipe.delete(*analytics_keys(token).values())
+    record_token_changes([token], client=pipe)
+    pipe.execute()
 
 def increment_token_usage(token: str) -> bool:
     """Increment token usage counter, return False if max reached"""
@@ -108,10 +824,353 @@ def increment_token_usage(token: str) -> bool:
     # Update in Redis
     expiration_time = int(data["expires_at"] - time.time())
     if expiration_time > 0:
-        redis_client.setex(f"token:{token}", expiration_time, json.dumps(data))
+        write_token(token, data, expiration_time)
     
     return True
 
+# Add hits to time buckets, keep the newest ARGV[3] buckets and the last access time
+RECORD_HITS_SCRIPT = redis_client.register_script("""
+for i = 4, #ARGV, 2 do
+    redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+local last = tonumber(redis.call('HGET', KEYS[1], 'last') or 0)
+if tonumber(ARGV[1]) > last then
+    redis.call('HSET', KEYS[1], 'last', ARGV[1])
+end
+local buckets = {}
+for _, field in ipairs(redis.call('HKEYS', KEYS[1])) do
+    if field ~= 'last' then
+        table.insert(buckets, field)
+    end
+end
+local extra = #buckets - tonumber(ARGV[3])
+if extra > 0 then
+    table.sort(buckets, function(a, b) return tonumber(a) < tonumber(b) end)
+    for i = 1, extra do
+        redis.call('HDEL', KEYS[1], buckets[i])
+    end
+end
+redis.call('EXPIREAT', KEYS[1], ARGV[2])
+""")
+
+analytics_queue = queue.Queue(maxsize=ANALYTICS_QUEUE_SIZE)
+
+def analytics_keys(token: str) -> dict:
+    return {kind: f"{ANALYTICS_PREFIX}{token}:{kind}" for kind in ("hits", "clients", "agents")}
+
+def client_details(request: Request) -> tuple:
+    """Client IP (as seen by nginx) and user agent"""
+    client_ip = request.headers.get("X-Real-IP") or (request.client.host if request.client else "")
+    return client_ip, request.headers.get("User-Agent", "")
+
+def record_token_access(token: str, token_data: dict, client_ip: str = "", user_agent: str = ""):
+    """Queue an access for the analytics thread without blocking the request"""
+    if not ANALYTICS_ENABLED:
+        return
+    try:
+        analytics_queue.put_nowait((token, time.time(), client_ip, user_agent, token_data["expires_at"]))
+    except queue.Full:
+        pass  # Analytics are best effort
+
+def write_token_accesses(batch: list):
+    """Aggregate queued accesses and write them with one pipeline"""
+    per_token = {}
+    for token, accessed_at, client_ip, user_agent, expires_at in batch:
+        entry = per_token.setdefault(token, {"hits": {}, "clients": set(), "agents": set(), "last": 0, "expires_at": 0})
+        bucket = int(accessed_at // ANALYTICS_BUCKET_SECONDS * ANALYTICS_BUCKET_SECONDS)
+        entry["hits"][bucket] = entry["hits"].get(bucket, 0) + 1
+        if client_ip:
+            entry["clients"].add(client_ip)
+        if user_agent:
+            entry["agents"].add(user_agent)
+        entry["last"] = max(entry["last"], int(accessed_at))
+        entry["expires_at"] = max(entry["expires_at"], int(expires_at) + 1)
+    
+    pipe = redis_client.pipeline(transaction=False)
+    for token, entry in per_token.items():
+        keys = analytics_keys(token)
+        hits = [value for bucket_hits in entry["hits"].items() for value in bucket_hits]
+        RECORD_HITS_SCRIPT(keys=[keys["hits"]], args=[entry["last"], entry["expires_at"], ANALYTICS_BUCKETS, *hits], client=pipe)
+        for kind in ("clients", "agents"):
+            if entry[kind]:
+                pipe.pfadd(keys[kind], *entry[kind])
+                pipe.expireat(keys[kind], entry["expires_at"])
+    pipe.execute()
+
+def analytics_worker():
+    """Write queued token accesses to Redis in batches"""
+    while True:
+        batch = [analytics_queue.get()]
+        while len(batch) < 500:
+            try:
+                batch.append(analytics_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            write_token_accesses(batch)
+        except redis.RedisError as e:
+            logger.warning("Failed to record %s token accesses: %s", len(batch), e)
+
+def get_analytics_summaries(token_ids: list) -> dict:
+    """Distinct clients, distinct user agents and last access for several tokens (one pipeline)"""
+    if not ANALYTICS_ENABLED or not token_ids:
+        return {}
+    pipe = redis_client.pipeline(transaction=False)
+    for token_id in token_ids:
+        keys = analytics_keys(token_id)
+        pipe.pfcount(keys["clients"])
+        pipe.pfcount(keys["agents"])
+        pipe.hget(keys["hits"], "last")
+    values = pipe.execute()
+    return {
+        token_id: {
+            "distinct_clients": values[3 * i],
+            "distinct_user_agents": values[3 * i + 1],
+            "last_access": int(values[3 * i + 2]) if values[3 * i + 2] else None
+        }
+        for i, token_id in enumerate(token_ids)
+    }
+
+# Share-session DICOMweb metadata cache (gzip-compressed, size-bounded LRU on disk or in Redis)
+METADATA_CACHE_BACKEND = os.getenv("METADATA_CACHE_BACKEND", "off")       # off | disk | redis
+METADATA_CACHE_DIR = os.getenv("METADATA_CACHE_DIR", "/app/cache/metadata")
+METADATA_CACHE_MAX_BYTES = int(os.getenv("METADATA_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))  # compressed size
+METADATA_CACHE_POLL_SECONDS = float(os.getenv("METADATA_CACHE_POLL_SECONDS", "10"))  # Orthanc /changes polling
+# Session token (a USER_ROLES key) used to read metadata and the change feed from Orthanc
+METADATA_CACHE_ORTHANC_TOKEN = os.getenv("METADATA_CACHE_ORTHANC_TOKEN", "admin")
+METADATA_CACHE_PREFIX = "metacache:"
+METADATA_GENERATIONS_KEY = "metacache:generations"   # Study UID (or "*" for all) -> generation
+METADATA_CHANGES_SEQ_KEY = "metacache:changes:last"  # Last Orthanc change handled
+METADATA_COUNTED_PREFIX = "metacache:counted:"       # Share tokens whose use was counted in the current validity window
+
+class DiskMetadataCache:
+    """LRU of compressed responses in METADATA_CACHE_DIR, recency tracked in memory"""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # File name -> size, oldest first
+        self.total = 0
+        os.makedirs(directory, exist_ok=True)
+        existing = []
+        for entry in os.scandir(directory):
+            if entry.name.endswith(".gz"):
+                existing.append((entry.stat().st_mtime, entry.name, entry.stat().st_size))
+        for _, name, size in sorted(existing):
+            self.entries[name] = size
+            self.total += size
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest() + ".gz")
+
+    def get(self, key: str):
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        with self.lock:
+            if os.path.basename(path) in self.entries:
+                self.entries.move_to_end(os.path.basename(path))
+        return data
+
+    def put(self, key: str, data: bytes):
+        path = self.path(key)
+        name = os.path.basename(path)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        evicted = []
+        with self.lock:
+            self.total += len(data) - self.entries.pop(name, 0)
+            self.entries[name] = len(data)
+            while self.total > self.max_bytes and self.entries:
+                oldest, size = self.entries.popitem(last=False)
+                self.total -= size
+                evicted.append(oldest)
+        for oldest in evicted:
+            try:
+                os.remove(os.path.join(self.directory, oldest))
+            except OSError:
+                pass
+
+class RedisMetadataCache:
+    """LRU of compressed responses in Redis (recency in a sorted set, sizes in a hash)"""
+
+    PUT_SCRIPT = """
+local previous = tonumber(redis.call('HGET', KEYS[3], KEYS[1]) or 0)
+redis.call('SET', KEYS[1], ARGV[1])
+redis.call('ZADD', KEYS[2], ARGV[2], KEYS[1])
+redis.call('HSET', KEYS[3], KEYS[1], #ARGV[1])
+local total = redis.call('INCRBY', KEYS[4], #ARGV[1] - previous)
+while total > tonumber(ARGV[3]) do
+    local oldest = redis.call('ZPOPMIN', KEYS[2])
+    if #oldest == 0 then
+        break
+    end
+    local size = tonumber(redis.call('HGET', KEYS[3], oldest[1]) or 0)
+    redis.call('DEL', oldest[1])
+    redis.call('HDEL', KEYS[3], oldest[1])
+    total = redis.call('DECRBY', KEYS[4], size)
+end
+"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        # Compressed payloads are binary: they cannot go through the decoding client
+        pool = redis_client.connection_pool
+        self.client = redis.Redis(connection_pool=redis.ConnectionPool(
+            connection_class=pool.connection_class,
+            **{**pool.connection_kwargs, "decode_responses": False}
+        ))
+        self.put_script = self.client.register_script(self.PUT_SCRIPT)
+        self.lru_key = f"{METADATA_CACHE_PREFIX}lru"
+        self.sizes_key = f"{METADATA_CACHE_PREFIX}sizes"
+        self.total_key = f"{METADATA_CACHE_PREFIX}total"
+
+    def entry_key(self, key: str) -> str:
+        return f"{METADATA_CACHE_PREFIX}entry:{hashlib.sha256(key.encode()).hexdigest()}"
+
+    def get(self, key: str):
+        entry_key = self.entry_key(key)
+        pipe = self.client.pipeline(transaction=False)
+        pipe.get(entry_key)
+        pipe.zadd(self.lru_key, {entry_key: time.time()}, xx=True)
+        return pipe.execute()[0]
+
+    def put(self, key: str, data: bytes):
+        self.put_script(
+            keys=[self.entry_key(key), self.lru_key, self.sizes_key, self.total_key],
+            args=[data, time.time(), self.max_bytes]
+        )
+
+if METADATA_CACHE_BACKEND == "disk":
+    metadata_cache = DiskMetadataCache(METADATA_CACHE_DIR, METADATA_CACHE_MAX_BYTES)
+elif METADATA_CACHE_BACKEND == "redis":
+    metadata_cache = RedisMetadataCache(METADATA_CACHE_MAX_BYTES)
+else:
+    metadata_cache = None
+
+def metadata_cache_key(study_uid: str, series_uid: str = "") -> str:
+    """Cache key including the study's generation, so invalidating is a counter bump"""
+    all_generation, study_generation = redis_client.hmget(METADATA_GENERATIONS_KEY, "*", study_uid)
+    return f"{study_uid}/{series_uid}@{all_generation or 0}.{study_generation or 0}"
+
+def invalidate_study_metadata(study_uids: list):
+    """Drop cached metadata of studies ("*" drops everything); stale entries age out of the LRU"""
+    if metadata_cache is None or not study_uids:
+        return
+    pipe = redis_client.pipeline(transaction=False)
+    for study_uid in set(study_uids):
+        pipe.hincrby(METADATA_GENERATIONS_KEY, study_uid, 1)
+    pipe.execute()
+
+def orthanc_service_get(path: str, accept: str = "application/json") -> bytes:
+    """GET an Orthanc resource with the metadata cache session token"""
+    headers = {"Accept": accept, "auth-token": METADATA_CACHE_ORTHANC_TOKEN}
+    request_id = current_request_id()
+    if request_id:
+        headers[REQUEST_ID_HEADER] = request_id
+    orthanc_request = urllib.request.Request(f"{ORTHANC_URL}{path}", headers=headers)
+    with urllib.request.urlopen(orthanc_request, timeout=PREWARM_TIMEOUT) as response:
+        return response.read()
+
+def poll_metadata_changes():
+    """Invalidate studies changed in Orthanc since the last poll"""
+    last = redis_client.get(METADATA_CHANGES_SEQ_KEY)
+    if last is None:
+        # First run: nothing cached predates the current change
+        last = json.loads(orthanc_service_get("/changes?last")).get("Last", 0)
+        redis_client.set(METADATA_CHANGES_SEQ_KEY, last)
+        return
+    while True:
+        changes = json.loads(orthanc_service_get(f"/changes?since={last}&limit=1000"))
+        changed_studies = []
+        for change in changes.get("Changes", []):
+            if change.get("ChangeType") == "Deleted":
+                changed_studies.append("*")     # The deleted resource's study can no longer be looked up
+            elif change.get("ResourceType") == "Study":
+                study = json.loads(orthanc_service_get(f"/studies/{change['ID']}"))
+                study_uid = study.get("MainDicomTags", {}).get("StudyInstanceUID")
+                if study_uid:
+                    changed_studies.append(study_uid)
+        invalidate_study_metadata(changed_studies)
+        last = changes.get("Last", last)
+        redis_client.set(METADATA_CHANGES_SEQ_KEY, last)
+        if changes.get("Done", True):
+            break
+
+def token_study_uids(resources: list) -> list:
+    """Study UIDs of a token's resources, series being looked up in Orthanc ("*" if a lookup fails)"""
+    study_uids = []
+    for resource in resources:
+        level = resource.get("Level", resource.get("level", "study"))
+        dicom_uid = resource.get("DicomUid", resource.get("dicom-uid", "")).strip()
+        orthanc_id = resource.get("OrthancId", resource.get("orthanc-id", ""))
+        if level == "study":
+            if dicom_uid:
+                study_uids.append(dicom_uid)
+            continue
+        if level != "series":
+            continue
+        try:
+            if orthanc_id:
+                study = json.loads(orthanc_service_get(f"/series/{urllib.parse.quote(orthanc_id, safe='')}/study"))
+                study_uid = study.get("MainDicomTags", {}).get("StudyInstanceUID", "")
+            elif dicom_uid:
+                matches = json.loads(orthanc_service_get(
+                    f"/dicom-web/series?SeriesInstanceUID={urllib.parse.quote(dicom_uid, safe='')}",
+                    accept="application/dicom+json") or b"[]")
+                study_uid = dicom_value(matches[0], "0020000D", "") if matches else ""
+            else:
+                continue
+        except (OSError, ValueError, http.client.HTTPException) as e:
+            logger.warning("Study lookup failed for series %s: %s", orthanc_id or dicom_uid, e)
+            study_uid = "*"
+        if study_uid:
+            study_uids.append(study_uid)
+    return study_uids
+
+def metadata_changes_worker():
+    """Follow Orthanc's change feed for the metadata cache"""
+    while True:
+        try:
+            poll_metadata_changes()
+        except (OSError, ValueError, redis.RedisError) as e:
+            logger.warning("Metadata cache change polling failed: %s", e)
+        time.sleep(METADATA_CACHE_POLL_SECONDS)
+
+def idempotency_key(creator: str, token_type: str, request_id: str, resources: list, validity_duration) -> str:
+    """Index key for a creation request: its plugin Id, or the requested resources and validity"""
+    if request_id:
+        request_key = {"id": request_id}
+    else:
+        request_key = {
+            "resources": sorted(json.dumps(resource, sort_keys=True) for resource in resources),
+            "validity": validity_duration
+        }
+    digest = hashlib.sha256(json.dumps([creator, token_type, request_key], sort_keys=True).encode()).hexdigest()
+    return f"{TOKENS_IDEMPOTENCY_PREFIX}{digest}"
+
+def find_reusable_token(key: str, validity_duration: int):
+    """Token previously created for the same request, if it can still be used"""
+    token = redis_client.get(key)
+    if not token:
+        return None
+    token_data = get_token(token)
+    if not token_data:
+        return None
+    # Short-lived tokens only need half their validity left
+    min_remaining = min(TOKEN_REUSE_MIN_REMAINING_SECONDS, validity_duration / 2)
+    if token_data["expires_at"] - time.time() < min_remaining:
+        return None
+    if token_data.get("current_uses", 0) >= token_data.get("max_uses", DEFAULT_TOKEN_MAX_USES) - 1:
+        return None
+    return token
+
 def verify_basic_auth(credentials: HTTPBasicCredentials = Depends(security)):
     """Verify HTTP Basic authentication"""
     correct_password = VALID_USERS.get(credentials.username)
@@ -119,6 +1178,10 @@ def verify_basic_auth(credentials: HTTPBasicCredentials = Depends(security)):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     return credentials.username
 
+def request_identity(request: Request) -> str:
+    """Authenticated user's email from Authelia (Remote-User carries the group), empty if not forwarded"""
+    return request.headers.get("Remote-Email", "").strip().lower()
+
 def verify_admin_auth(request: Request):
     """Verify admin authentication from Authelia headers"""
     remote_groups = request.headers.get("Remote-Groups", "")
@@ -136,13 +1199,21 @@ def get_base_url(request: Request) -> str:
     scheme = "https" if request.headers.get("X-Forwarded-Proto") == "https" else "http"
     return f"{scheme}://{host}"
 
+def load_template(template_name: str) -> str:
+    """Read a template from disk once and keep it in memory"""
+    template_content = template_cache.get(template_name)
+    if template_content is None:
+        with open(f"{TEMPLATES_DIR}/{template_name}", "r", encoding="utf-8") as f:
+            template_content = f.read()
+        template_cache[template_name] = template_content
+    return template_content
+
 def render_template(template_name: str, **kwargs) -> str:
     """Render HTML template with provided variables"""
-    template_path = f"/app/templates/{template_name}"
+    template_path = f"{TEMPLATES_DIR}/{template_name}"
     try:
-        with open(template_path, "r", encoding="utf-8") as f:
-            template_content = f.read()
-        return template_content.format(font_awesome_cdn=FONT_AWESOME_CDN, **kwargs)
+        template_content = load_template(template_name)
+        return template_content.format(font_awesome_cdn=FONT_AWESOME_URL, **kwargs)
     except FileNotFoundError:
         logger.error(f"Template not found: {template_path}")
         return f"<html><body><h1>Template Error</h1><p>Template not found: {template_name}</p></body></html>"
@@ -181,11 +1252,7 @@ def get_settings_roles(username: str = Depends(verify_basic_auth)):
     # Return roles and permissions adapted to our PACS environment
     # OHIF, VolView, Explorer 2 - no Osimis
     return {
-        "roles": [
-            "admin-role",
-            "doctor-role", 
-            "external-role"
-        ],
+        "roles": AVAILABLE_ROLES,
         "permissions": [
             "view",           # Read access to studies/series/instances
             "download",       # Download DICOM files
@@ -218,20 +1285,18 @@ async def validate_token(request: Request, username: str = Depends(verify_basic_
     dicom_uid = body.get("dicom-uid", "")
     uri = body.get("uri", "")
     
-    # Log the validation request
-    logger.debug(f"Token validation request: {body}")
-    logger.debug(f"Token value: {token_value}")
-    logger.debug(f"Level: {level}, Method: {method}, URI: {uri}")
-    logger.debug(f"Orthanc ID: {orthanc_id}, DICOM UID: {dicom_uid}")
+    # Log the validation request (formatted by the log thread, only if DEBUG is enabled)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Token validation request", extra={"fields": {
+            "token": token_value, "resource_level": level, "method": method, "uri": uri,
+            "orthanc_id": orthanc_id, "dicom_uid": dicom_uid
+        }})
     
     # Check user session tokens (mapped from nginx groups)
     if token_value in USER_ROLES:
         role = USER_ROLES[token_value]
         granted = check_permission_for_role(role, level, method, uri)
-        return JSONResponse(content={
-            "granted": granted,
-            "validity": CACHE_VALIDITY_USER_SESSION
-        })
+        return validation_response(granted, CACHE_VALIDITY_USER_SESSION if granted else CACHE_VALIDITY_DENIED, "session")
     
     # Check generated share tokens in Redis
     token_data = get_token(token_value)
@@ -239,30 +1304,48 @@ async def validate_token(request: Request, username: str = Depends(verify_basic_
         # Check if token has expired (Redis auto-expires, but double-check)
         if time.time() >= token_data["expires_at"]:
             delete_token(token_value)
-            return JSONResponse(content={
-                "granted": False,
-                "validity": 0
-            })
+            return validation_response(False, CACHE_VALIDITY_DENIED, "expired")
         
         # Increment usage counter and check limits
         if not increment_token_usage(token_value):
-            return JSONResponse(content={
-                "granted": False,
-                "validity": 0
-            })
+            return validation_response(False, CACHE_VALIDITY_DENIED, "usage-limit")
+        token_data["current_uses"] = token_data.get("current_uses", 0) + 1
+        
+        # Orthanc does not forward the client: only the access time is recorded here
+        record_token_access(token_value, token_data)
         
         # For share tokens, check if the requested resource matches the token's resources
         granted = check_resource_access(token_data, level, method, orthanc_id, dicom_uid, uri)
-        
-        return JSONResponse(content={
-            "granted": granted,
-            "validity": CACHE_VALIDITY_SHARE_TOKEN
-        })
+        if not granted:
+            return validation_response(False, CACHE_VALIDITY_DENIED, "resource")
+        return validation_response(True, share_token_validity(token_data), "share-token")
     
     # Token not found
+    return validation_response(False, CACHE_VALIDITY_DENIED, "unknown-token")
+
+def share_token_validity(token_data: dict) -> int:
+    """Seconds Orthanc may cache a granted share token decision"""
+    max_uses = token_data.get("max_uses", DEFAULT_TOKEN_MAX_USES)
+    remaining_uses = max_uses - token_data.get("current_uses", 0)
+    # Cached decisions are not counted as uses: re-check often when the limit is close
+    if remaining_uses <= max(1, max_uses * CACHE_VALIDITY_LOW_USES):
+        validity = CACHE_VALIDITY_SHARE_TOKEN
+    else:
+        validity = max(CACHE_VALIDITY_SHARE_TOKEN_MAX, CACHE_VALIDITY_SHARE_TOKEN)
+    validity = min(validity, TOKEN_REVOCATION_MAX_DELAY)
+    # Never beyond the token's own expiry
+    return max(0, min(validity, int(token_data["expires_at"] - time.time())))
+
+def validation_response(granted: bool, validity: int, reason: str) -> JSONResponse:
+    """Authorization plugin answer, with the decision recorded on the request trace"""
+    trace = current_trace.get()
+    if trace is not None and trace.stack:
+        trace.stack[0]["tags"].update({"auth.granted": str(granted).lower(), "auth.validity": str(validity), "auth.reason": reason})
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Token validation decision", extra={"fields": {"granted": granted, "validity": validity, "reason": reason}})
     return JSONResponse(content={
-        "granted": False,
-        "validity": 0
+        "granted": granted,
+        "validity": validity
     })
 
 def check_permission_for_role(role: str, level: str, method: str, uri: str) -> bool:
@@ -408,21 +1491,38 @@ async def create_token(token_type: str, request: Request):
     if validity_duration == 0:
         validity_duration = UNLIMITED_TOKEN_DURATION
     
-    # Generate unique token
-    token = str(uuid.uuid4())
-    
-    # Store token in Redis with expiration and resources
-    token_data = {
-        "token_type": token_type,
-        "request_id": request_id,
-        "resources": resources,
-        "role": "external-role",  # Share tokens are read-only
-        "expires_at": time.time() + validity_duration,
-        "created_at": time.time(),
-        "max_uses": DEFAULT_TOKEN_MAX_USES,
-        "current_uses": 0
-    }
-    store_token(token, token_data)
+    # Retries and re-opened share dialogs get the token already created for them (?force=true for a new one)
+    force = request.query_params.get("force", "false").lower() == "true"
+    creator = request_identity(request)
+    reuse_key = None
+    # Without a per-user identity, matching on resources would hand one user's token to everyone in the group
+    if creator or request_id:
+        reuse_key = idempotency_key(creator or remote_user, token_type, request_id, resources, expiration_date or validity_duration)
+    token = None
+    if TOKEN_REUSE_ENABLED and not force and reuse_key:
+        token = find_reusable_token(reuse_key, validity_duration)
+        if token:
+            logger.info("Reusing token %s for %s (type: %s)", token, creator or remote_user, token_type)
+    
+    if not token:
+        # Generate unique token
+        token = str(uuid.uuid4())
+        
+        # Store token in Redis with expiration and resources
+        token_data = {
+            "token_type": token_type,
+            "request_id": request_id,
+            "resources": resources,
+            "role": "external-role",  # Share tokens are read-only
+            "created_by": creator or remote_user,
+            "expires_at": time.time() + validity_duration,
+            "created_at": time.time(),
+            "max_uses": DEFAULT_TOKEN_MAX_USES,
+            "current_uses": 0
+        }
+        store_token(token, token_data)
+        if TOKEN_REUSE_ENABLED and reuse_key and int(validity_duration) > 0:
+            redis_client.set(reuse_key, token, ex=int(validity_duration))
     
     # Generate URL based on token type
     base_url = get_base_url(request)
@@ -443,46 +1543,136 @@ async def create_token(token_type: str, request: Request):
     
     return JSONResponse(content=response_data)
 
+def format_token_entry(token_id: str, token_data: dict) -> dict:
+    """Add listing fields (id, remaining time, formatted creation date) to token data"""
+    # Add token ID to the data
+    token_data["id"] = token_id
+    # Calculate remaining time
+    remaining_time = max(0, int(token_data.get("expires_at", time.time()) - time.time()))
+    token_data["remaining_seconds"] = remaining_time
+    # Format creation time
+    try:
+        created_at = token_data.get("created_at", time.time())
+        token_data["created_at_formatted"] = time.strftime(
+            "%Y-%m-%d %H:%M:%S", 
+            time.localtime(created_at)
+        )
+    except (ValueError, OSError, KeyError):
+        token_data["created_at_formatted"] = "Unknown"
+    return token_data
+
+def add_analytics(tokens: list):
+    """Attach access analytics summaries to listing entries"""
+    summaries = get_analytics_summaries([token["id"] for token in tokens])
+    for token in tokens:
+        if token["id"] in summaries:
+            token["analytics"] = summaries[token["id"]]
+
+def dump_json(content) -> bytes:
+    """Serialize with orjson when installed"""
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, separators=(",", ":"), ensure_ascii=False).encode()
+
+def accepted_encodings(request: Request) -> set:
+    """Content codings the client accepts (q=0 excluded)"""
+    encodings = set()
+    for item in request.headers.get("Accept-Encoding", "").split(","):
+        coding, _, params = item.partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        if coding.strip():
+            encodings.add(coding.strip().lower())
+    return encodings
+
+def api_response(request: Request, content, headers: dict = None) -> Response:
+    """JSON response for the token APIs, compressed with brotli or gzip when the client accepts it"""
+    body = dump_json(content)
+    headers = {**(headers or {}), "Vary": "Accept-Encoding"}
+    if len(body) >= RESPONSE_COMPRESSION_MIN_BYTES:
+        encodings = accepted_encodings(request)
+        if brotli is not None and "br" in encodings:
+            body = brotli.compress(body, quality=RESPONSE_BROTLI_QUALITY)
+            headers["Content-Encoding"] = "br"
+        elif "gzip" in encodings:
+            body = gzip.compress(body, compresslevel=RESPONSE_GZIP_LEVEL)
+            headers["Content-Encoding"] = "gzip"
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def project_tokens(tokens: list, fields: str) -> list:
+    """Keep only the requested fields of each token (the id is always kept)"""
+    if not fields:
+        return tokens
+    wanted = {field.strip() for field in fields.split(",") if field.strip()} | {"id"}
+    return [{key: value for key, value in token.items() if key in wanted} for token in tokens]
+
+def version_etag(version: int, variant: str = "") -> str:
+    # Weak: the same version is sent gzip/brotli-encoded or not (nginx also weakens ETags it gzips)
+    if variant:
+        return f'W/"tokens-{version}-{zlib.crc32(variant.encode()):08x}"'
+    return f'W/"tokens-{version}"'
+
+def not_modified(request: Request, etag: str):
+    """304 response if the client already has this version, else None"""
+    if_none_match = request.headers.get("If-None-Match", "")
+    # Weak comparison
+    if etag.removeprefix("W/") in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers={"ETag": etag})
+    return None
+
 @app.get("/tokens")
-async def list_tokens(request: Request):
-    """List all active tokens with their metadata"""
+async def list_tokens(request: Request, since: int = None, fields: str = None):
+    """List all active tokens with their metadata (or only changes with ?since=<version>)
+
+    ?fields=id,token_type,... limits each token to these fields.
+    """
     verify_admin_auth(request)
     
-    # Get all tokens from Redis
-    tokens = []
-    cursor = 0
-    while True:
-        cursor, keys = redis_client.scan(cursor, match="token:*", count=100)
-        for key in keys:
-            token_id = key.replace("token:", "")
-            token_data = get_token(token_id)
-            if token_data:
-                # Add token ID to the data
-                token_data["id"] = token_id
-                # Calculate remaining time
-                remaining_time = max(0, int(token_data.get("expires_at", time.time()) - time.time()))
-                token_data["remaining_seconds"] = remaining_time
-                # Format creation time
-                try:
-                    created_at = token_data.get("created_at", time.time())
-                    token_data["created_at_formatted"] = time.strftime(
-                        "%Y-%m-%d %H:%M:%S", 
-                        time.localtime(created_at)
-                    )
-                except (ValueError, OSError, KeyError):
-                    token_data["created_at_formatted"] = "Unknown"
-                tokens.append(token_data)
-        
-        if cursor == 0:
-            break
+    sweep_expired_tokens()
+    # Read the version first: changes made while listing are sent again next time
+    version = get_change_version()
+    etag = version_etag(version, fields or "")
+    with_analytics = not fields or "analytics" in fields.split(",")
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+    
+    floor = int(redis_client.get(TOKENS_CHANGES_FLOOR_KEY) or 0)
+    if since is not None and floor <= since <= version:
+        # Delta mode: tokens changed after `since`; those that no longer exist were removed
+        changed = redis_client.zrangebyscore(TOKENS_CHANGES_KEY, f"({since}", version)
+        tokens = []
+        removed = []
+        for token_id, data in zip(changed, get_tokens(changed)):
+            if data:
+                tokens.append(format_token_entry(token_id, json.loads(data)))
+            else:
+                removed.append(token_id)
+        if with_analytics:
+            add_analytics(tokens)
+        return api_response(request, {
+            "version": version,
+            "since": since,
+            "full": False,
+            "tokens": project_tokens(tokens, fields),
+            "removed": removed,
+            "count": len(tokens)
+        }, headers={"ETag": etag})
+    
+    # Get all tokens from Redis (every shard)
+    tokens = [format_token_entry(token_id, token_data) for token_id, token_data in scan_all_tokens()]
+    if with_analytics:
+        add_analytics(tokens)
     
     # Sort by creation date (newest first)
     tokens.sort(key=lambda x: x.get("created_at", 0), reverse=True)
     
-    return JSONResponse(content={
-        "tokens": tokens,
+    return api_response(request, {
+        "version": version,
+        "full": True,
+        "tokens": project_tokens(tokens, fields),
         "count": len(tokens)
-    })
+    }, headers={"ETag": etag})
 
 @app.delete("/tokens/{token_id}")
 async def revoke_token(token_id: str, request: Request):
@@ -515,6 +1705,8 @@ async def revoke_token(token_id: str, request: Request):
     
     # Delete the token
     delete_token(token_id)
+    if metadata_cache is not None:
+        invalidate_study_metadata(await run_in_threadpool(token_study_uids, token_data.get("resources", [])))
     
     return JSONResponse(content={
         "message": "Token revoked successfully",
@@ -523,46 +1715,71 @@ async def revoke_token(token_id: str, request: Request):
         "revoked_at": time.time()
     })
 
+@app.get("/tokens/{token_id}/analytics")
+async def token_analytics(token_id: str, request: Request):
+    """Access analytics of one token: distinct clients and accesses over time"""
+    verify_admin_auth(request)
+    
+    token_data = get_token(token_id)
+    if not token_data:
+        raise HTTPException(status_code=404, detail="Token not found")
+    
+    keys = analytics_keys(token_id)
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.pfcount(keys["clients"])
+    pipe.pfcount(keys["agents"])
+    pipe.hgetall(keys["hits"])
+    distinct_clients, distinct_agents, hits = pipe.execute()
+    last_access = hits.pop("last", None)
+    
+    return api_response(request, {
+        "id": token_id,
+        "current_uses": token_data.get("current_uses", 0),
+        "max_uses": token_data.get("max_uses", DEFAULT_TOKEN_MAX_USES),
+        "distinct_clients": distinct_clients,
+        "distinct_user_agents": distinct_agents,
+        "last_access": int(last_access) if last_access else None,
+        "bucket_seconds": ANALYTICS_BUCKET_SECONDS,
+        "accesses": [{"start": int(start), "count": int(count)} for start, count in sorted(hits.items(), key=lambda item: int(item[0]))]
+    })
+
 @app.get("/tokens/stats")
 async def token_stats(request: Request):
     """Get statistics about tokens"""
     verify_admin_auth(request)
     
+    sweep_expired_tokens()
+    etag = version_etag(get_change_version())
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+    
     # Collect statistics
     total_tokens = 0
     tokens_by_type = {}
     tokens_by_usage = {"low": 0, "medium": 0, "high": 0}
     
-    cursor = 0
-    while True:
-        cursor, keys = redis_client.scan(cursor, match="token:*", count=100)
-        for key in keys:
-            token_id = key.replace("token:", "")
-            token_data = get_token(token_id)
-            if token_data:
-                total_tokens += 1
-                
-                # Count by type
-                token_type = token_data.get("token_type", "unknown")
-                tokens_by_type[token_type] = tokens_by_type.get(token_type, 0) + 1
-                
-                # Count by usage
-                usage_percent = (token_data.get("current_uses", 0) / token_data.get("max_uses", DEFAULT_TOKEN_MAX_USES)) * 100
-                if usage_percent < 33:
-                    tokens_by_usage["low"] += 1
-                elif usage_percent < 66:
-                    tokens_by_usage["medium"] += 1
-                else:
-                    tokens_by_usage["high"] += 1
+    for token_id, token_data in scan_all_tokens():
+        total_tokens += 1
         
-        if cursor == 0:
-            break
+        # Count by type
+        token_type = token_data.get("token_type", "unknown")
+        tokens_by_type[token_type] = tokens_by_type.get(token_type, 0) + 1
+        
+        # Count by usage
+        usage_percent = (token_data.get("current_uses", 0) / token_data.get("max_uses", DEFAULT_TOKEN_MAX_USES)) * 100
+        if usage_percent < 33:
+            tokens_by_usage["low"] += 1
+        elif usage_percent < 66:
+            tokens_by_usage["medium"] += 1
+        else:
+            tokens_by_usage["high"] += 1
     
-    return JSONResponse(content={
+    return api_response(request, {
         "total_active_tokens": total_tokens,
         "tokens_by_type": tokens_by_type,
         "tokens_by_usage": tokens_by_usage
-    })
+    }, headers={"ETag": etag})
 
 @app.get("/tokens/test")
 async def token_test_interface(request: Request):
@@ -638,6 +1855,11 @@ async def share_redirect(request: Request):
     if not increment_token_usage(token):
         return render_error_template("Lien expiré", UI_MESSAGES["USAGE_LIMIT"], "fas fa-clock", 410)
     
+    record_token_access(token, token_data, *client_details(request))
+    
+    # Let Orthanc load the study while the browser follows the redirect
+    enqueue_study_prewarm(study_uid)
+    
     # Redirect to OHIF with study and token for Authorization Plugin
     base_url = get_base_url(request)
     # Add cache-busting parameter to force config reload
@@ -646,39 +1868,382 @@ async def share_redirect(request: Request):
     study_uid_encoded = urllib.parse.quote(study_uid, safe='')
     ohif_url = f"{base_url}/ohif/viewer?StudyInstanceUIDs={study_uid_encoded}&token={token}&_cb={cache_bust}"
     
-    return HTMLResponse(content=f"""
-        <html>
-            <head>
-                <title>Redirection vers OHIF</title>
-                <meta http-equiv="refresh" content="0; url={ohif_url}">
-                <link href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.5.1/css/all.min.css" rel="stylesheet">
-                <style>
-                    body {{ font-family: Avenir, Helvetica, Arial, sans-serif; 
-                           background: #1e242a; color: #e0e0e0; text-align: center; padding: 50px; margin: 0;
-                           -webkit-font-smoothing: antialiased; -moz-osx-font-smoothing: grayscale; }}
-                    h1 {{ color: #6ea0c8; margin-bottom: 20px; }}
-                    p {{ color: #b0b0b0; }}
-                    a {{ color: #6ea0c8; text-decoration: none; }}
-                    a:hover {{ text-decoration: underline; }}
-                    .icon {{ font-size: 1.2em; margin-right: 8px; }}
-                </style>
-            </head>
-            <body>
-                <h1><i class="fas fa-spinner fa-pulse icon"></i>Redirection...</h1>
-                <p>Redirection vers l'étude...</p>
-                <p><a href="{ohif_url}">Cliquer ici si la redirection ne fonctionne pas</a></p>
-            </body>
-        </html>
-    """)
+    # Never cache: every opening of the link must be counted
+    headers = {"Cache-Control": "no-store"}
+    if SHARE_REDIRECT_MODE == "direct":
+        return RedirectResponse(url=ohif_url, status_code=302, headers=headers)
+    
+    content = render_template("redirect.html", ohif_url=ohif_url)
+    return HTMLResponse(content=content, headers=headers)
+
+@app.get("/share/download")
+async def share_download(request: Request):
+    """Stream the shared study as a ZIP archive (counts as one token use)"""
+    token = request.query_params.get("token")
+    
+    if not token:
+        return render_error_template("Lien invalide", UI_MESSAGES["INVALID_TOKEN"], "fas fa-shield-alt", 400)
+    if not DOWNLOAD_ENABLED:
+        raise HTTPException(status_code=404, detail="Downloads are disabled")
+    
+    # Validate the token once: the archive is then fetched with the service's own session token
+    token_data = get_token(token)
+    if not token_data or time.time() >= token_data["expires_at"]:
+        return render_error_template("Lien expiré", UI_MESSAGES["EXPIRED_TOKEN"], "fas fa-clock", 410)
+    if token_data.get("current_uses", 0) >= token_data.get("max_uses", DEFAULT_TOKEN_MAX_USES):
+        return render_error_template("Lien expiré", UI_MESSAGES["USAGE_LIMIT"], "fas fa-clock", 410)
+    
+    study = next((resource for resource in token_data.get("resources", [])
+                  if resource.get("Level", resource.get("level", "study")) == "study"), None)
+    if not study:
+        return render_error_template("Aucune étude", UI_MESSAGES["NO_STUDY"], "fas fa-folder-open", 400)
+    orthanc_id = study.get("OrthancId", study.get("orthanc-id", ""))
+    study_uid = study.get("DicomUid", study.get("dicom-uid", "")).strip()
+    
+    # Protect Orthanc: archives are expensive to build
+    if not download_slots.acquire(blocking=False):
+        response = render_error_template("Service occupé", UI_MESSAGES["DOWNLOAD_BUSY"], "fas fa-hourglass-half", 503)
+        response.headers["Retry-After"] = "30"
+        return response
+    
+    download = None
+    streaming = False
+    try:
+        if not orthanc_id and study_uid:
+            orthanc_id = await run_in_threadpool(lookup_orthanc_study, study_uid)
+        if not orthanc_id:
+            return render_error_template("Étude invalide", UI_MESSAGES["INVALID_STUDY"], "fas fa-exclamation-triangle", 400)
+        download = await run_in_threadpool(StudyDownload, orthanc_id, current_request_id())
+        
+        # Count the download once Orthanc has accepted it
+        if not increment_token_usage(token):
+            return render_error_template("Lien expiré", UI_MESSAGES["USAGE_LIMIT"], "fas fa-clock", 410)
+        
+        record_token_access(token, token_data, *client_details(request))
+        logger.info("Study download started: %s (token %s)", orthanc_id, token)
+        headers = {
+            "Content-Disposition": f'attachment; filename="study-{orthanc_id[:8]}.zip"',
+            "Cache-Control": "no-store",
+            "X-Accel-Buffering": "no"
+        }
+        if download.content_length:
+            headers["Content-Length"] = download.content_length
+        # The background task also runs when the client disconnects before the stream ends
+        response = StreamingResponse(download.chunks(), media_type="application/zip", headers=headers,
+                                     background=BackgroundTask(download.close))
+        streaming = True
+        return response
+    except (OSError, ValueError, http.client.HTTPException) as e:
+        logger.warning("Download failed for study %s: %s", orthanc_id or study_uid, e)
+        return render_error_template("Téléchargement impossible", UI_MESSAGES["DOWNLOAD_FAILED"], "fas fa-exclamation-triangle", 502)
+    finally:
+        # Every path that does not hand the archive to the response gives the slot back (Redis errors included)
+        if not streaming:
+            if download:
+                download.close()
+            else:
+                download_slots.release()
+
+def relay_share_metadata(path: str, token: str) -> Response:
+    """Orthanc's metadata response as is, requested with the share token (Orthanc validates and counts it)"""
+    headers = {"Accept": "application/dicom+json", "auth-token": token}
+    request_id = current_request_id()
+    if request_id:
+        headers[REQUEST_ID_HEADER] = request_id
+    orthanc_request = urllib.request.Request(f"{ORTHANC_URL}{path}", headers=headers)
+    try:
+        with urllib.request.urlopen(orthanc_request, timeout=PREWARM_TIMEOUT) as response:
+            return Response(content=response.read(), status_code=response.status,
+                            media_type=response.headers.get("Content-Type", "application/dicom+json"),
+                            headers={"X-Metadata-Cache": "off"})
+    except urllib.error.HTTPError as e:
+        raise HTTPException(status_code=e.code, detail="Orthanc request failed")
+    except (OSError, http.client.HTTPException) as e:
+        logger.warning("Metadata relay failed for %s: %s", path, e)
+        raise HTTPException(status_code=502, detail="Orthanc unavailable")
+
+def share_metadata_allowed(token_data: dict, study_uid: str, series_uid: str = "") -> bool:
+    """Study-level resources cover their study and its series; series-level ones only that exact series"""
+    for resource in token_data.get("resources", []):
+        level = resource.get("Level", resource.get("level", "study"))
+        dicom_uid = resource.get("DicomUid", resource.get("dicom-uid", "")).strip()
+        if level == "study" and dicom_uid == study_uid:
+            return True
+        if level == "series" and series_uid and dicom_uid == series_uid:
+            return True
+    return False
+
+def count_share_metadata_use(token: str, token_data: dict) -> bool:
+    """Count a use the way Orthanc's cached validations do: at most once per validity window"""
+    validity = share_token_validity(token_data)
+    if validity > 0 and not redis_client.set(f"{METADATA_COUNTED_PREFIX}{token}", 1, ex=validity, nx=True):
+        return True
+    return increment_token_usage(token)
+
+@app.get("/share/dicom-web/studies/{study_uid}/metadata")
+@app.get("/share/dicom-web/studies/{study_uid}/series/{series_uid}/metadata")
+def share_metadata(study_uid: str, request: Request, series_uid: str = ""):
+    """DICOMweb metadata of a shared study, from the metadata cache when possible"""
+    token = normalize_bearer_token(request.query_params.get("token", ""))
+    
+    path = f"/dicom-web/studies/{urllib.parse.quote(study_uid, safe='')}"
+    if series_uid:
+        path += f"/series/{urllib.parse.quote(series_uid, safe='')}"
+    path += "/metadata"
+    
+    # Cache disabled: behave as if nginx had sent the request straight to Orthanc
+    if metadata_cache is None:
+        return relay_share_metadata(path, token)
+    
+    # Same checks as /tokens/validate, since Orthanc does not see the share token on this path
+    token_data = get_token(token) if token else None
+    if not token_data or time.time() >= token_data["expires_at"]:
+        raise HTTPException(status_code=401, detail="Invalid or expired token")
+    if token_data.get("current_uses", 0) >= token_data.get("max_uses", DEFAULT_TOKEN_MAX_USES):
+        raise HTTPException(status_code=401, detail="Token usage limit reached")
+    # The data is read with METADATA_CACHE_ORTHANC_TOKEN: the study in the URL must be the shared one
+    if not share_metadata_allowed(token_data, study_uid, series_uid):
+        raise HTTPException(status_code=403, detail="Resource not covered by this token")
+    if not count_share_metadata_use(token, token_data):
+        raise HTTPException(status_code=401, detail="Token usage limit reached")
+    
+    cache_key = metadata_cache_key(study_uid, series_uid)
+    compressed = metadata_cache.get(cache_key)
+    cache_status = "hit" if compressed else "miss"
+    if compressed is None:
+        try:
+            compressed = gzip.compress(orthanc_service_get(path, accept="application/dicom+json"), compresslevel=6)
+        except urllib.error.HTTPError as e:
+            raise HTTPException(status_code=e.code, detail="Orthanc request failed")
+        except (OSError, http.client.HTTPException) as e:
+            logger.warning("Metadata fetch failed for study %s: %s", study_uid, e)
+            raise HTTPException(status_code=502, detail="Orthanc unavailable")
+        try:
+            metadata_cache.put(cache_key, compressed)
+        except (OSError, redis.RedisError) as e:
+            logger.warning("Metadata cache write failed: %s", e)
+    
+    headers = {"X-Metadata-Cache": cache_status, "Vary": "Accept-Encoding"}
+    # Stored compressed: sent as is to clients accepting gzip
+    if "gzip" in accepted_encodings(request):
+        headers["Content-Encoding"] = "gzip"
+        return Response(content=compressed, media_type="application/dicom+json", headers=headers)
+    return Response(content=gzip.decompress(compressed), media_type="application/dicom+json", headers=headers)
+
+@app.get("/debug/profile")
+async def profile_worker(request: Request, seconds: float = 10, interval_ms: float = PROFILE_DEFAULT_INTERVAL_MS):
+    """Sample this worker for a few seconds and return collapsed stacks (flamegraph.pl / speedscope)"""
+    verify_admin_auth(request)
+    
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be between 0 and {PROFILE_MAX_SECONDS}")
+    if interval_ms < 1:
+        raise HTTPException(status_code=400, detail="interval_ms must be at least 1")
+    if not profile_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    
+    counts = {}
+    stop = threading.Event()
+    sampler = threading.Thread(target=sample_stacks, args=(stop, interval_ms / 1000, counts),
+                               name="profiler", daemon=True)
+    try:
+        logger.info("Profiling worker %s for %ss", os.getpid(), seconds)
+        sampler.start()
+        # Keep serving requests on the event loop while it is being sampled
+        await asyncio.sleep(seconds)
+    finally:
+        stop.set()
+        sampler.join()
+        profile_lock.release()
+    
+    lines = [f"{stack} {count}" for stack, count in sorted(counts.items(), key=lambda item: -item[1])]
+    return PlainTextResponse("\n".join(lines) + "\n", headers={"X-Profile-Pid": str(os.getpid())})
+
+def check_redis() -> dict:
+    """Ping every Redis node and measure round-trip latency"""
+    nodes = {REDIS_PRIMARY_NODE: redis_client, **token_shards()}
+    result = {"ok": True, "max_latency_ms": READINESS_REDIS_MAX_LATENCY_MS, "nodes": {}}
+    for name, client in nodes.items():
+        start = time.perf_counter()
+        try:
+            client.ping()
+        except redis.RedisError as e:
+            result["ok"] = False
+            result["nodes"][name] = {"ok": False, "error": str(e)}
+            continue
+        latency_ms = round((time.perf_counter() - start) * 1000, 2)
+        node_ok = latency_ms <= READINESS_REDIS_MAX_LATENCY_MS
+        result["ok"] = result["ok"] and node_ok
+        result["nodes"][name] = {"ok": node_ok, "latency_ms": latency_ms}
+    return result
+
+def check_templates() -> dict:
+    """Check that every template needed to answer users is loadable"""
+    missing = []
+    for template_name in REQUIRED_TEMPLATES:
+        try:
+            load_template(template_name)
+        except OSError:
+            missing.append(template_name)
+    return {"ok": not missing, "missing": missing}
+
+def check_policy() -> dict:
+    """Check the configuration the authorization decisions depend on"""
+    # Authorization plugin credentials come from the environment and may be left empty
+    missing_credentials = not all(VALID_USERS) or not all(VALID_USERS.values())
+    # Session tokens the service sends to Orthanc must map to a role allowed to read studies
+    service_tokens = {"ORTHANC_SERVICE_TOKEN": ORTHANC_SERVICE_TOKEN, "METADATA_CACHE_ORTHANC_TOKEN": METADATA_CACHE_ORTHANC_TOKEN}
+    unusable_tokens = [
+        name for name, value in service_tokens.items()
+        if value not in USER_ROLES or not check_permission_for_role(USER_ROLES[value], "study", "get", "")
+    ]
+    return {
+        "ok": not missing_credentials and not unusable_tokens,
+        "missing_credentials": missing_credentials,
+        "unusable_service_tokens": unusable_tokens
+    }
+
+def warm_redis_connections():
+    """Open pooled Redis connections (on every node) ahead of the first requests"""
+    pools = {id(client.connection_pool): client.connection_pool
+             for client in [redis_client, *token_shards().values()]}
+    warmed = 0
+    for pool in pools.values():
+        connections = []
+        try:
+            for _ in range(min(WARMUP_REDIS_CONNECTIONS, REDIS_MAX_CONNECTIONS)):
+                connection = pool.get_connection("PING")
+                connections.append(connection)
+                connection.send_command("PING")
+                connection.read_response()
+        finally:
+            for connection in connections:
+                pool.release(connection)
+        warmed += len(connections)
+    return warmed
+
+@app.on_event("startup")
+def start_metadata_changes_worker():
+    """Start following Orthanc changes to invalidate cached metadata"""
+    if metadata_cache is not None:
+        threading.Thread(target=metadata_changes_worker, name="metadata-changes", daemon=True).start()
+
+@app.on_event("startup")
+def start_analytics_worker():
+    """Start the background thread recording token accesses"""
+    if ANALYTICS_ENABLED:
+        threading.Thread(target=analytics_worker, name="token-analytics", daemon=True).start()
+
+@app.on_event("startup")
+def start_trace_exporter():
+    """Start the background thread exporting traces"""
+    if TRACING_ENABLED and (TRACE_EXPORT_FILE or TRACE_COLLECTOR_URL):
+        threading.Thread(target=trace_export_worker, name="trace-exporter", daemon=True).start()
+
+@app.on_event("startup")
+def warm_start():
+    """Preload templates and Redis connections so the first requests are not slower"""
+    for template_name in REQUIRED_TEMPLATES:
+        try:
+            load_template(template_name)
+        except OSError:
+            logger.error("Template not found at startup: %s", template_name)
+    try:
+        warmed = warm_redis_connections()
+        logger.info("Warm start: %s Redis connections", warmed)
+    except redis.RedisError as e:
+        logger.warning("Warm start: Redis unavailable (%s)", e)
+
+@app.on_event("shutdown")
+def stop_prewarm_workers():
+    """Drop queued warm-ups on shutdown"""
+    prewarm_executor.shutdown(wait=False, cancel_futures=True)
 
 @app.get("/health")
+@app.get("/health/live")
 def health_check():
+    """Liveness probe: the process is up and serving requests"""
     return JSONResponse(content={
         "status": "healthy",
         "service": "auth-service",
         "version": "1.0.0"
     })
 
+@app.get("/health/ready")
+def readiness_check():
+    """Readiness probe: dependencies are reachable and configuration is loaded"""
+    checks = {
+        "redis": check_redis(),
+        "templates": check_templates(),
+        "policy": check_policy()
+    }
+    ready = all(check["ok"] for check in checks.values())
+    return JSONResponse(content={
+        "status": "ready" if ready else "not-ready",
+        "service": "auth-service",
+        "checks": checks
+    }, status_code=200 if ready else 503)
+
+def rebalance_shards(previous_nodes: list = None, dry_run: bool = False) -> dict:
+    """Move tokens to the shard that owns them on the current ring.
+
+    previous_nodes lists nodes that were removed from REDIS_SHARDS and still hold tokens.
+    Keys are copied with DUMP/RESTORE so their remaining TTL is kept.
+    """
+    sources = dict(token_shards())
+    for spec in previous_nodes or []:
+        host, port, db = parse_redis_node(spec)
+        name = f"{host}:{port}/{db}"
+        if name not in sources:
+            sources[name] = redis_client if name == REDIS_PRIMARY_NODE else create_redis_client(host, port, db)
+    raw_clients = {}
+
+    def raw(client):
+        # DUMP payloads are binary: they cannot go through the decoding clients
+        if id(client) not in raw_clients:
+            pool = client.connection_pool
+            raw_clients[id(client)] = redis.Redis(connection_pool=redis.ConnectionPool(
+                connection_class=pool.connection_class,
+                **{**pool.connection_kwargs, "decode_responses": False}
+            ))
+        return raw_clients[id(client)]
+
+    moved = {}
+    for name, source in sources.items():
+        cursor = 0
+        while True:
+            cursor, keys = source.scan(cursor, match="token:*", count=100)
+            for key in keys:
+                target = token_shard(key[len("token:"):])
+                if target is source:
+                    continue
+                moved[name] = moved.get(name, 0) + 1
+                if dry_run:
+                    continue
+                pipe = raw(source).pipeline(transaction=False)
+                pipe.dump(key)
+                pipe.pttl(key)
+                payload, ttl_ms = pipe.execute()
+                if payload is None or ttl_ms == -2:
+                    continue  # Expired meanwhile
+                raw(target).restore(key, max(ttl_ms, 0), payload, replace=True)
+                source.delete(key)
+            if cursor == 0:
+                break
+    return {"dry_run": dry_run, "moved": moved, "total": sum(moved.values())}
+
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser(description="Auth service")
+    subparsers = parser.add_subparsers(dest="command")
+    rebalance_parser = subparsers.add_parser("rebalance", help="Move tokens to their shard after changing REDIS_SHARDS")
+    rebalance_parser.add_argument("--from", dest="previous_nodes", nargs="*", default=[],
+                                  help="Nodes removed from REDIS_SHARDS that still hold tokens (host:port/db)")
+    rebalance_parser.add_argument("--dry-run", action="store_true", help="Only count the tokens to move")
+    args = parser.parse_args()
+
+    if args.command == "rebalance":
+        print(json.dumps(rebalance_shards(args.previous_nodes, args.dry_run), indent=2))
+    else:
+        import uvicorn
+        uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -36,11 +36,22 @@ const CONFIG = {
         EXPIRED_TOKENS: '/auth/tokens/expired',
         STATS: '/auth/tokens/stats',
         REVOKE: '/auth/tokens'
-    }
+    },
+    // Token fields used by the tables and the usage checks (the API sends only these)
+    TOKEN_FIELDS: ['id', 'token_type', 'resources', 'created_at', 'expires_at', 'remaining_seconds', 'current_uses', 'max_uses', 'analytics']
 };
 
 let currentTokenToRevoke = null;
 
+// Token list kept in sync with the server via delta requests
+const tokenState = {
+    version: null,          // Server change version of the local copy
+    tokens: new Map()       // Token ID -> token
+};
+
+// Last response and ETag per endpoint for conditional requests
+const conditionalCache = new Map();
+
 // Debug logging
 if (CONFIG.DEBUG_MODE) {
     console.log('Token Manager loaded with config:', CONFIG);
@@ -107,7 +118,7 @@ function getExpirationReason(token) {
     return `<span class="badge ${CONFIG.CSS_CLASSES.DANGER}">Révoqué</span>`;
 }
 
-// Generic API call function
+// Generic API call function (GET requests are conditional: a 304 returns the cached data)
 async function apiCall(endpoint, method = 'GET', data = null) {
     try {
         const url = `${CONFIG.API_BASE}${endpoint}`;
@@ -120,6 +131,13 @@ async function apiCall(endpoint, method = 'GET', data = null) {
             credentials: 'include'
         };
 
+        // One entry per endpoint: the ETag only depends on the version, not on ?since=
+        const cacheKey = endpoint.replace(/[?&]since=[^&]*/, '');
+        const cached = method === 'GET' ? conditionalCache.get(cacheKey) : null;
+        if (cached) {
+            options.headers['If-None-Match'] = cached.etag;
+        }
+
         if (data) {
             options.headers['Content-Type'] = 'application/json';
             options.body = JSON.stringify(data);
@@ -127,21 +145,58 @@ async function apiCall(endpoint, method = 'GET', data = null) {
 
         const response = await fetch(url, options);
 
+        if (response.status === 304 && cached) {
+            return cached.data;
+        }
+
         if (!response.ok) {
             throw new Error(`HTTP error! status: ${response.status}`);
         }
 
-        return await response.json();
+        const result = await response.json();
+        const etag = response.headers.get('ETag');
+        if (method === 'GET' && etag) {
+            conditionalCache.set(cacheKey, { etag, data: result });
+        }
+        return result;
     } catch (error) {
         console.error(`API call failed for ${endpoint}:`, error);
         throw error;
     }
 }
 
-// Fetch tokens from API
+// Fetch tokens from API: full list first, then only changes since the last version
 async function fetchTokens() {
-    const data = await apiCall(CONFIG.ENDPOINTS.TOKENS);
-    return data.tokens || [];
+    const fields = `fields=${CONFIG.TOKEN_FIELDS.join(',')}`;
+    const endpoint = tokenState.version === null
+        ? `${CONFIG.ENDPOINTS.TOKENS}?${fields}`
+        : `${CONFIG.ENDPOINTS.TOKENS}?${fields}&since=${tokenState.version}`;
+    const data = await apiCall(endpoint);
+
+    if (data.version !== tokenState.version) {
+        if (data.full) {
+            tokenState.tokens.clear();
+        }
+        (data.tokens || []).forEach(token => tokenState.tokens.set(token.id, token));
+        (data.removed || []).forEach(tokenId => tokenState.tokens.delete(tokenId));
+        tokenState.version = data.version;
+        if (CONFIG.DEBUG_MODE) {
+            console.log(`Token sync: version ${data.version}, ${(data.tokens || []).length} changed, ${(data.removed || []).length} removed`);
+        }
+    }
+
+    // Drop tokens that expired since the last change and refresh remaining time locally
+    const now = Date.now() / 1000;
+    const tokens = [];
+    tokenState.tokens.forEach((token, tokenId) => {
+        if (token.expires_at && token.expires_at <= now) {
+            tokenState.tokens.delete(tokenId);
+            return;
+        }
+        token.remaining_seconds = Math.max(0, Math.floor((token.expires_at || now) - now));
+        tokens.push(token);
+    });
+    return tokens.sort((a, b) => (b.created_at || 0) - (a.created_at || 0));
 }
 
 // Fetch expired tokens from API
@@ -239,6 +294,7 @@ function createTokensTableHTML(tokens) {
                         </div>
                         <small class="${CONFIG.CSS_CLASSES.TEXT_MUTED}">${token.current_uses}/${token.max_uses}</small>
                     </div>
+                    ${token.analytics ? `<small class="${CONFIG.CSS_CLASSES.TEXT_MUTED}" title="Clients distincts (IP) / navigateurs distincts"><i class="fas fa-users me-1"></i>${token.analytics.distinct_clients} / ${token.analytics.distinct_user_agents}</small>` : ''}
                 </td>
                 <td>
                     <button class="btn btn-sm btn-outline-danger" onclick="confirmRevoke('${token.id}', '${token.token_type}')">
@@ -390,20 +446,22 @@ async function loadData() {
     const expiredContainer = document.getElementById('expiredTokensContainer');
     
     try {
-        // Show loading state
-        container.innerHTML = `
-            <div class="loading">
-                <i class="${CONFIG.ICONS.SPINNER} fa-2x mb-3 ${CONFIG.CSS_CLASSES.TEXT_WHITE}"></i>
-                <p>Chargement des tokens...</p>
-            </div>
-        `;
+        // Show loading state on first load only (refreshes are incremental)
+        if (tokenState.version === null) {
+            container.innerHTML = `
+                <div class="loading">
+                    <i class="${CONFIG.ICONS.SPINNER} fa-2x mb-3 ${CONFIG.CSS_CLASSES.TEXT_WHITE}"></i>
+                    <p>Chargement des tokens...</p>
+                </div>
+            `;
         
-        expiredContainer.innerHTML = `
-            <div class="loading">
-                <i class="${CONFIG.ICONS.SPINNER} fa-2x mb-3 ${CONFIG.CSS_CLASSES.TEXT_WHITE}"></i>
-                <p>Chargement des tokens expirés...</p>
-            </div>
-        `;
+            expiredContainer.innerHTML = `
+                <div class="loading">
+                    <i class="${CONFIG.ICONS.SPINNER} fa-2x mb-3 ${CONFIG.CSS_CLASSES.TEXT_WHITE}"></i>
+                    <p>Chargement des tokens expirés...</p>
+                </div>
+            `;
+        }
         
         // Fetch data in parallel
         const [tokens, expiredTokens, stats] = await Promise.all([
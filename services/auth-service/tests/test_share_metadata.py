@@ -0,0 +1,84 @@
+"""Access checks of the share-session metadata route (metadata cache enabled)
+
+Run with: python -m pytest services/auth-service/tests (needs pytest and fakeredis)
+"""
+import os
+import sys
+import time
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+if not os.path.isdir("/app/static"):
+    pytest.skip("auth_service mounts /app/static at import (run in the auth-service image)", allow_module_level=True)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import auth_service
+from fastapi.testclient import TestClient
+
+
+@pytest.fixture
+def service(monkeypatch, tmp_path):
+    """Client with an in-memory Redis, a disk cache and a fake Orthanc recording the paths it serves"""
+    fetched = []
+    monkeypatch.setattr(auth_service, "redis_client", fakeredis.FakeRedis(decode_responses=True))
+    monkeypatch.setattr(auth_service, "metadata_cache", auth_service.DiskMetadataCache(str(tmp_path), 1 << 20))
+    monkeypatch.setattr(auth_service, "orthanc_service_get",
+                        lambda path, accept="application/json": fetched.append(path) or b"[]")
+    return TestClient(auth_service.app), fetched
+
+
+def share_token(dicom_uid: str, level: str) -> str:
+    token = f"test-{level}-{dicom_uid}"
+    auth_service.store_token(token, {
+        "token_type": "ohif-viewer-publication",
+        "resources": [{"DicomUid": dicom_uid, "Level": level}],
+        "role": "external-role",
+        "expires_at": time.time() + 3600,
+        "created_at": time.time(),
+        "max_uses": 50,
+        "current_uses": 0
+    })
+    return token
+
+
+def test_study_token_cannot_read_series_of_another_study(service):
+    client, fetched = service
+    token = share_token("1.2.3", "study")
+
+    response = client.get(f"/share/dicom-web/studies/9.9.9/series/7.7.7/metadata?token={token}")
+
+    assert response.status_code == 403
+    assert fetched == []
+
+
+def test_study_token_reads_its_study_and_series(service):
+    client, fetched = service
+    token = share_token("1.2.3", "study")
+
+    assert client.get(f"/share/dicom-web/studies/1.2.3/metadata?token={token}").status_code == 200
+    assert client.get(f"/share/dicom-web/studies/1.2.3/series/4.5.6/metadata?token={token}").status_code == 200
+    assert fetched == ["/dicom-web/studies/1.2.3/metadata", "/dicom-web/studies/1.2.3/series/4.5.6/metadata"]
+
+
+def test_series_token_reads_only_its_series(service):
+    client, fetched = service
+    token = share_token("4.5.6", "series")
+
+    assert client.get(f"/share/dicom-web/studies/1.2.3/series/4.5.6/metadata?token={token}").status_code == 200
+    assert client.get(f"/share/dicom-web/studies/1.2.3/metadata?token={token}").status_code == 403
+    assert client.get(f"/share/dicom-web/studies/1.2.3/series/7.7.7/metadata?token={token}").status_code == 403
+    assert fetched == ["/dicom-web/studies/1.2.3/series/4.5.6/metadata"]
+
+
+def test_revoking_series_token_invalidates_its_study(service, monkeypatch):
+    client, fetched = service
+    token = share_token("4.5.6", "series")
+    monkeypatch.setattr(auth_service, "orthanc_service_get",
+                        lambda path, accept="application/json": b'[{"0020000D": {"vr": "UI", "Value": ["1.2.3"]}}]')
+    before = auth_service.metadata_cache_key("1.2.3", "4.5.6")
+
+    response = client.delete(f"/tokens/{token}", headers={"Remote-User": "admin", "Remote-Groups": "admin"})
+
+    assert response.status_code == 200
+    assert auth_service.metadata_cache_key("1.2.3", "4.5.6") != before
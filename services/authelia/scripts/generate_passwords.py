@@ -15,6 +15,7 @@ import argon2
 # =============================================================================
 # Configure Argon2ID hasher with same parameters as Authelia configuration
 # These parameters must match the settings in configuration.yml
+# Measure login latency for other settings with: manage_users.py calibrate
 hasher = argon2.PasswordHasher(
     time_cost=1,        # Number of iterations (low for PACS performance)
     memory_cost=128,    # Memory usage in MB
@@ -11,27 +11,167 @@
 #   delete <email>          - Delete user
 #   password <email> <new>  - Change user password
 #   list                    - List all users
+#   batch <manifest>        - Apply a CSV/YAML manifest in one write and one restart
+#   calibrate               - Benchmark Argon2id parameters under concurrent logins
+#
+# Password hashes are generated in-process with argon2-cffi (pip install
+# argon2-cffi) using the parameters from Authelia's configuration.yml.
 
 import argparse
+import copy
+import csv
+import fnmatch
+import json
+import math
+import re
+import tempfile
+import time
 import yaml
 import subprocess
 import sys
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
+# Use libyaml's C loader/dumper when PyYAML was built with it
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+YamlDumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+try:
+    import argon2
+except ImportError:  # Fall back to Authelia's container for hashing
+    argon2 = None
+
 # =============================================================================
 # CONFIGURATION
 # =============================================================================
 USERS_FILE = "/volume2/docker/orthanc/services/authelia/config/users_database.yml"
+CONFIG_FILE = "/volume2/docker/orthanc/services/authelia/config/configuration.yml"
+# Lookup index (no password hashes) rebuilt whenever USERS_FILE changes
+INDEX_FILE = os.path.join(os.path.dirname(USERS_FILE), ".users_index.json")
 CONTAINER_NAME = "orthanc-authelia"
 
+# PACS roles accepted as Authelia groups
+VALID_GROUPS = ["admin", "doctor", "external"]
+MIN_PASSWORD_LENGTH = 6
+
+# Hash in a process pool when at least this many passwords are requested
+PARALLEL_HASH_THRESHOLD = 8
+
+# Authelia defaults for argon2id (used when configuration.yml omits a value)
+ARGON2_DEFAULTS = {
+    "time_cost": 3,         # iterations
+    "memory_cost": 65536,   # KiB
+    "parallelism": 4,
+    "hash_len": 32,         # key_length
+    "salt_len": 16
+}
+
 # =============================================================================
 # PASSWORD HASH GENERATION
 # =============================================================================
+_hasher = None
+
+def load_argon2_parameters(config_file=CONFIG_FILE):
+    """
+    Read Argon2 parameters from Authelia's configuration.yml
+    
+    Supports both the legacy layout (password.iterations, memory in MB)
+    and the current one (password.argon2.*, memory in KiB).
+    
+    Args:
+        config_file (str): Path to Authelia configuration.yml
+        
+    Returns:
+        dict: Keyword arguments for argon2.PasswordHasher
+    """
+    params = dict(ARGON2_DEFAULTS)
+    if not os.path.exists(config_file):
+        return params
+    
+    with open(config_file, 'r', encoding='utf-8') as f:
+        config = yaml.load(f, Loader=YamlLoader) or {}
+    
+    password = (config.get("authentication_backend", {})
+                      .get("file", {})
+                      .get("password", {})) or {}
+    
+    if isinstance(password.get("argon2"), dict):
+        # Authelia >= 4.38: memory expressed in KiB
+        section = password["argon2"]
+        memory_kib = section.get("memory")
+    else:
+        # Legacy layout: memory expressed in MB
+        section = password
+        memory_kib = section["memory"] * 1024 if "memory" in section else None
+    
+    if "iterations" in section:
+        params["time_cost"] = int(section["iterations"])
+    if memory_kib is not None:
+        params["memory_cost"] = int(memory_kib)
+    if "parallelism" in section:
+        params["parallelism"] = int(section["parallelism"])
+    if "key_length" in section:
+        params["hash_len"] = int(section["key_length"])
+    if "salt_length" in section:
+        params["salt_len"] = int(section["salt_length"])
+    return params
+
+def get_hasher():
+    """
+    Build the Argon2ID hasher once per process
+    
+    Returns:
+        argon2.PasswordHasher: Hasher matching Authelia's configuration
+    """
+    global _hasher
+    if _hasher is None:
+        _hasher = argon2.PasswordHasher(type=argon2.Type.ID, **load_argon2_parameters())
+    return _hasher
+
 def generate_password_hash(password):
+    """
+    Generate Argon2ID hash for a password in-process
+    
+    Args:
+        password (str): Plain text password to hash
+        
+    Returns:
+        str: Argon2ID hash or None if error
+    """
+    if argon2 is None:
+        return generate_password_hash_docker(password)
+    
+    try:
+        return get_hasher().hash(password)
+    except (argon2.exceptions.HashingError, ValueError, yaml.YAMLError) as e:
+        print(f"❌ Error generating password hash: {e}")
+        return None
+
+def generate_password_hashes(passwords):
+    """
+    Generate Argon2ID hashes for several passwords
+    
+    Large batches are spread over a process pool (one hash per core).
+    
+    Args:
+        passwords (list): Plain text passwords to hash
+        
+    Returns:
+        list: Hashes in the same order (None for failures)
+    """
+    if argon2 is None or len(passwords) < PARALLEL_HASH_THRESHOLD:
+        return [generate_password_hash(password) for password in passwords]
+    
+    with ProcessPoolExecutor() as executor:
+        return list(executor.map(generate_password_hash, passwords))
+
+def generate_password_hash_docker(password):
     """
     Generate Argon2ID hash for a password using Authelia's crypto utility
     
+    Used only when the argon2 library is not installed.
+    
     Args:
         password (str): Plain text password to hash
         
@@ -71,7 +211,62 @@ def load_users():
         return {"users": {}}
     
     with open(USERS_FILE, 'r', encoding='utf-8') as f:
-        return yaml.safe_load(f) or {"users": {}}
+        data = yaml.load(f, Loader=YamlLoader) or {}
+    if not data.get("users"):
+        data["users"] = {}
+    return data
+
+def users_file_signature():
+    """
+    Identify the current version of USERS_FILE
+    
+    Returns:
+        list: [mtime_ns, size] or None if the file does not exist
+    """
+    try:
+        stat = os.stat(USERS_FILE)
+    except FileNotFoundError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+def load_user_index():
+    """
+    Load the user lookup index, rebuilding it when USERS_FILE changed
+    
+    The index holds email, display name and groups only (no password
+    hashes) as JSON, which is much faster to read than the YAML database.
+    
+    Returns:
+        dict: email -> {"displayname", "groups"}
+    """
+    signature = users_file_signature()
+    if signature is None:
+        return {}
+    
+    try:
+        with open(INDEX_FILE, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        if index.get("signature") == signature:
+            return index["users"]
+    except (OSError, ValueError, KeyError):
+        pass
+    
+    users = {
+        email: {
+            "displayname": user_data.get("displayname", ""),
+            "groups": user_data.get("groups", [])
+        }
+        for email, user_data in load_users()["users"].items()
+    }
+    try:
+        fd, tmp_path = tempfile.mkstemp(prefix=".users_index.", suffix=".json",
+                                        dir=os.path.dirname(INDEX_FILE) or ".")
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({"signature": signature, "users": users}, f)
+        os.replace(tmp_path, INDEX_FILE)
+    except OSError:
+        pass  # Index is an optimisation only (e.g. read-only config directory)
+    return users
 
 def save_users(data):
     """
@@ -80,8 +275,22 @@ def save_users(data):
     Args:
         data (dict): User database structure to save
     """
-    with open(USERS_FILE, 'w', encoding='utf-8') as f:
-        yaml.dump(data, f, default_flow_style=False, allow_unicode=True)
+    # Write to a temporary file in the same directory then rename it over the
+    # database, so Authelia never reads a partially written file
+    directory = os.path.dirname(USERS_FILE) or "."
+    fd, tmp_path = tempfile.mkstemp(prefix=".users_database.", suffix=".yml", dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            yaml.dump(data, f, Dumper=YamlDumper, default_flow_style=False, allow_unicode=True)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(USERS_FILE):
+            os.chmod(tmp_path, os.stat(USERS_FILE).st_mode & 0o777)
+        os.replace(tmp_path, USERS_FILE)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
 
 def restart_authelia():
     """
@@ -93,6 +302,47 @@ def restart_authelia():
     except subprocess.CalledProcessError:
         print("❌ Error restarting Authelia container")
 
+# =============================================================================
+# VALIDATION
+# =============================================================================
+def parse_groups(groups):
+    """
+    Split a group list (comma or semicolon separated)
+    
+    Args:
+        groups (str|list): Groups as a string or list
+        
+    Returns:
+        list: Group names
+    """
+    if isinstance(groups, (list, tuple)):
+        return [str(g).strip() for g in groups if str(g).strip()]
+    return [g.strip() for g in re.split(r'[,;]', groups or '') if g.strip()]
+
+def validate_user_fields(email=None, password=None, group_list=None):
+    """
+    Validate user fields against PACS rules
+    
+    Args:
+        email (str): Email to check (skipped if None)
+        password (str): Password to check (skipped if None)
+        group_list (list): Groups to check (skipped if None)
+        
+    Returns:
+        str: Error message or None if valid
+    """
+    if email is not None and (not email or '@' not in email):
+        return "Invalid email address"
+    if password is not None and (not password or len(password) < MIN_PASSWORD_LENGTH):
+        return f"Password too short (minimum {MIN_PASSWORD_LENGTH} characters)"
+    if group_list is not None:
+        if not group_list:
+            return "At least one group is required"
+        for group in group_list:
+            if group not in VALID_GROUPS:
+                return f"Invalid group: {group}. Valid groups: {VALID_GROUPS}"
+    return None
+
 # =============================================================================
 # USER MANAGEMENT COMMANDS
 # =============================================================================
@@ -103,24 +353,28 @@ def init_database():
     """
     print("🔧 Initializing user database...")
     
+    admin_hash, doctor_hash, external_hash = generate_password_hashes(
+        ["admin123", "doctor123", "external123"]
+    )
+    
     # Default users for PACS environment with different access levels
     default_users = {
         "users": {
             "admin@example.com": {
                 "displayname": "PACS Administrator",         # Full system access
-                "password": generate_password_hash("admin123"),
+                "password": admin_hash,
                 "email": "admin@example.com",
                 "groups": ["admin"]
             },
             "doctor@example.com": {
                 "displayname": "Medical Doctor",              # Medical access
-                "password": generate_password_hash("doctor123"), 
+                "password": doctor_hash, 
                 "email": "doctor@example.com",
                 "groups": ["doctor"]
             },
             "external@example.com": {
                 "displayname": "External User",               # Limited access
-                "password": generate_password_hash("external123"),
+                "password": external_hash,
                 "email": "external@example.com", 
                 "groups": ["external"]
             }
@@ -149,25 +403,13 @@ def add_user(email, password, displayname, groups):
     """
     print(f"➕ Adding user {email}...")
     
-    # Validate email format
-    if not email or '@' not in email:
-        print("❌ Invalid email address")
+    # Validate email format, password strength and groups against PACS roles
+    group_list = parse_groups(groups)
+    error = validate_user_fields(email, password, group_list)
+    if error:
+        print(f"❌ {error}")
         return
     
-    # Validate password strength
-    if not password or len(password) < 6:
-        print("❌ Password too short (minimum 6 characters)")
-        return
-    
-    # Validate groups against PACS roles
-    valid_groups = ["admin", "doctor", "external"]
-    group_list = [g.strip() for g in groups.split(',')]
-    
-    for group in group_list:
-        if group not in valid_groups:
-            print(f"❌ Invalid group: {group}. Valid groups: {valid_groups}")
-            return
-    
     data = load_users()
     
     # Check if user already exists
@@ -228,8 +470,9 @@ def change_password(email, new_password):
     print(f"🔑 Changing password for {email}...")
     
     # Validate password strength
-    if len(new_password) < 6:
-        print("❌ Password too short (minimum 6 characters)")
+    error = validate_user_fields(password=new_password)
+    if error:
+        print(f"❌ {error}")
         return
     
     data = load_users()
@@ -250,20 +493,92 @@ def change_password(email, new_password):
     
     restart_authelia()
 
-def list_users():
+def describe_access(groups):
     """
-    List all users in the database with their details
+    Describe the PACS access level granted by a set of groups
     """
-    print("👥 User list:")
+    if "admin" in groups:
+        return "Full PACS administration"
+    if "doctor" in groups:
+        return "Medical imaging and patient data"
+    if "external" in groups:
+        return "Limited read-only access"
+    return ""
+
+def filter_users(users, group=None, email_pattern=None, name=None):
+    """
+    Filter the user index
     
-    data = load_users()
+    Args:
+        users (dict): email -> user summary (from load_user_index)
+        group (str): Keep users in this group
+        email_pattern (str): Shell-style pattern matched against email (case-insensitive)
+        name (str): Substring matched against display name (case-insensitive)
+        
+    Returns:
+        list: (email, user summary) tuples sorted by email
+    """
+    email_pattern = email_pattern.lower() if email_pattern else None
+    name = name.lower() if name else None
     
-    if not data["users"]:
+    matches = []
+    for email, user_data in users.items():
+        if group and group not in user_data.get("groups", []):
+            continue
+        if email_pattern and not fnmatch.fnmatchcase(email.lower(), email_pattern):
+            continue
+        if name and name not in (user_data.get("displayname") or "").lower():
+            continue
+        matches.append((email, user_data))
+    matches.sort(key=lambda item: item[0])
+    return matches
+
+def list_users(group=None, email_pattern=None, name=None, page=1, page_size=50, as_json=False):
+    """
+    List users in the database with their details
+    
+    Args:
+        group (str): Only users in this group
+        email_pattern (str): Shell-style email pattern (e.g. '*@hospital.com')
+        name (str): Display name substring
+        page (int): Page number (1-based)
+        page_size (int): Users per page (0 = all)
+        as_json (bool): Print machine-readable JSON
+    """
+    matches = filter_users(load_user_index(), group, email_pattern, name)
+    total = len(matches)
+    page = max(page, 1)
+    if page_size > 0:
+        pages = max((total + page_size - 1) // page_size, 1)
+        matches = matches[(page - 1) * page_size:page * page_size]
+    else:
+        pages = 1
+    
+    if as_json:
+        print(json.dumps({
+            "total": total,
+            "page": page,
+            "pages": pages,
+            "page_size": page_size,
+            "users": [
+                {
+                    "email": email,
+                    "displayname": user_data.get("displayname", ""),
+                    "groups": user_data.get("groups", [])
+                }
+                for email, user_data in matches
+            ]
+        }, ensure_ascii=False, indent=2))
+        return
+    
+    print("👥 User list:")
+    
+    if not matches:
         print("   No users found")
         return
     
     # Display users with their roles and access levels
-    for email, user_data in data["users"].items():
+    for email, user_data in matches:
         groups = ", ".join(user_data.get("groups", []))
         displayname = user_data.get("displayname", "")
         print(f"   📧 {email}")
@@ -271,13 +586,371 @@ def list_users():
         print(f"      Groups: {groups}")
         
         # Show access level description
-        if "admin" in user_data.get("groups", []):
-            print(f"      Access: Full PACS administration")
-        elif "doctor" in user_data.get("groups", []):
-            print(f"      Access: Medical imaging and patient data")
-        elif "external" in user_data.get("groups", []):
-            print(f"      Access: Limited read-only access")
+        access = describe_access(user_data.get("groups", []))
+        if access:
+            print(f"      Access: {access}")
+        print()
+    
+    print(f"   Page {page}/{pages} - {total} matching user(s)")
+
+# =============================================================================
+# BATCH OPERATIONS
+# =============================================================================
+BATCH_ACTIONS = ["add", "delete", "password", "groups"]
+
+def load_manifest(path):
+    """
+    Load batch operations from a CSV or YAML manifest
+    
+    CSV columns: action,email,password,name,groups
+    YAML: a list of mappings with the same keys (or {"operations": [...]})
+    
+    Args:
+        path (str): Manifest file path
+        
+    Returns:
+        list: Operations as dicts
+    """
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        if path.lower().endswith('.csv'):
+            return [dict(row) for row in csv.DictReader(f)]
+        data = yaml.load(f, Loader=YamlLoader) or []
+    if isinstance(data, dict):
+        data = data.get("operations", [])
+    return list(data)
+
+def plan_batch(users, operations):
+    """
+    Apply operations to a copy of the user table without hashing passwords
+    
+    Args:
+        users (dict): Current users mapping
+        operations (list): Operations from load_manifest()
+        
+    Returns:
+        tuple: (new users mapping, [(email, password)] to hash, [errors])
+    """
+    new_users = copy.deepcopy(users)
+    pending_passwords = {}
+    errors = []
+    
+    for index, op in enumerate(operations, 1):
+        action = str(op.get("action") or "").strip().lower()
+        email = str(op.get("email") or "").strip()
+        password = op.get("password")
+        password = str(password) if password not in (None, "") else None
+        
+        if action not in BATCH_ACTIONS:
+            errors.append(f"#{index}: unknown action '{action}' (valid: {', '.join(BATCH_ACTIONS)})")
+            continue
+        
+        if action == "add":
+            group_list = parse_groups(op.get("groups") or "external")
+            error = validate_user_fields(email, password or "", group_list)
+            if not error and email in new_users:
+                error = f"user {email} already exists"
+            if error:
+                errors.append(f"#{index} {email}: {error}")
+                continue
+            new_users[email] = {
+                "displayname": str(op.get("name") or "").strip() or email,
+                "password": None,
+                "email": email,
+                "groups": group_list
+            }
+            pending_passwords[email] = password
+            continue
+        
+        if email not in new_users:
+            errors.append(f"#{index} {email}: user does not exist")
+            continue
+        
+        if action == "delete":
+            del new_users[email]
+            pending_passwords.pop(email, None)
+        elif action == "password":
+            error = validate_user_fields(password=password or "")
+            if error:
+                errors.append(f"#{index} {email}: {error}")
+                continue
+            pending_passwords[email] = password
+        elif action == "groups":
+            group_list = parse_groups(op.get("groups"))
+            error = validate_user_fields(group_list=group_list)
+            if error:
+                errors.append(f"#{index} {email}: {error}")
+                continue
+            new_users[email]["groups"] = group_list
+    
+    return new_users, list(pending_passwords.items()), errors
+
+def diff_users(old_users, new_users, pending_passwords):
+    """
+    Describe changes between two user tables
+    
+    Returns:
+        list: (symbol, email, description) tuples
+    """
+    changes = []
+    reset = {email for email, _ in pending_passwords}
+    for email in sorted(set(old_users) | set(new_users)):
+        if email not in new_users:
+            changes.append(("-", email, "removed"))
+        elif email not in old_users:
+            groups = ", ".join(new_users[email].get("groups", []))
+            changes.append(("+", email, f"added (groups: {groups})"))
+        else:
+            details = []
+            old_groups = old_users[email].get("groups", [])
+            new_groups = new_users[email].get("groups", [])
+            if old_groups != new_groups:
+                details.append(f"groups: {', '.join(old_groups)} -> {', '.join(new_groups)}")
+            if email in reset:
+                details.append("password reset")
+            if details:
+                changes.append(("~", email, "; ".join(details)))
+    return changes
+
+def batch_apply(manifest, dry_run=False, restart=True):
+    """
+    Apply a manifest of user changes with a single write and restart
+    
+    Args:
+        manifest (str): CSV or YAML manifest path
+        dry_run (bool): Only print the planned changes
+        restart (bool): Restart Authelia after writing
+    """
+    print(f"📋 Loading manifest {manifest}...")
+    
+    try:
+        operations = load_manifest(manifest)
+    except (OSError, yaml.YAMLError, csv.Error) as e:
+        print(f"❌ Cannot read manifest: {e}")
+        return
+    
+    data = load_users()
+    users = data.get("users") or {}
+    new_users, pending_passwords, errors = plan_batch(users, operations)
+    
+    if errors:
+        print(f"❌ {len(errors)} invalid operation(s), nothing applied:")
+        for error in errors:
+            print(f"   - {error}")
+        return
+    
+    changes = diff_users(users, new_users, pending_passwords)
+    if not changes:
+        print("✅ No changes to apply")
+        return
+    
+    print(f"📝 {len(changes)} change(s):")
+    for symbol, email, description in changes:
+        print(f"   {symbol} {email}: {description}")
+    
+    if dry_run:
+        print("🔍 Dry run: no changes written")
+        return
+    
+    # Hash all new passwords at once (in parallel for large batches)
+    if pending_passwords:
+        print(f"🔑 Hashing {len(pending_passwords)} password(s)...")
+        hashes = generate_password_hashes([password for _, password in pending_passwords])
+        for (email, _), password_hash in zip(pending_passwords, hashes):
+            if not password_hash:
+                print(f"❌ Error generating password hash for {email}, nothing applied")
+                return
+            new_users[email]["password"] = password_hash
+    
+    data["users"] = new_users
+    save_users(data)
+    print(f"✅ {len(changes)} change(s) written to {USERS_FILE}")
+    
+    if restart:
+        restart_authelia()
+
+# =============================================================================
+# ARGON2 CALIBRATION
+# =============================================================================
+# Candidate parameter sets as (iterations, memory in MB, parallelism),
+# from weakest to strongest
+CALIBRATION_CANDIDATES = [
+    (1, 64, 4),
+    (1, 128, 8),
+    (2, 64, 4),
+    (3, 64, 4),
+    (2, 128, 4),
+    (3, 128, 4),
+    (4, 256, 4),
+]
+
+def parse_candidates(value):
+    """
+    Parse candidates given as 'iterations:memory_mb:parallelism,...'
+    
+    Returns:
+        list: (iterations, memory_mb, parallelism) tuples
+    """
+    candidates = []
+    for item in value.split(','):
+        iterations, memory_mb, parallelism = (int(part) for part in item.strip().split(':'))
+        candidates.append((iterations, memory_mb, parallelism))
+    return candidates
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of a list of values
+    """
+    ordered = sorted(values)
+    rank = max(math.ceil(fraction * len(ordered)), 1)
+    return ordered[rank - 1]
+
+def _timed_hash(params):
+    """
+    Hash a password in a worker process
+    
+    Returns:
+        tuple: (seconds spent hashing, peak RSS of the worker in KiB)
+    """
+    import resource
+    start = time.perf_counter()
+    argon2.PasswordHasher(type=argon2.Type.ID, **params).hash("calibration-password")
+    elapsed = time.perf_counter() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return elapsed, peak_rss
+
+def benchmark_candidate(candidate, concurrency, workers, rounds):
+    """
+    Simulate bursts of simultaneous logins for one parameter set
+    
+    Every round submits `concurrency` hashes at once; a login's latency is
+    measured from the start of the burst to the end of its hash, so queueing
+    behind other logins is included.
+    
+    Returns:
+        dict: Latency percentiles, throughput and memory figures
+    """
+    iterations, memory_mb, parallelism = candidate
+    params = dict(ARGON2_DEFAULTS,
+                  time_cost=iterations,
+                  memory_cost=memory_mb * 1024,
+                  parallelism=parallelism)
+    
+    latencies = []
+    hash_times = []
+    peak_rss = 0
+    total_wall = 0.0
+    
+    # Fresh pool per candidate so worker RSS reflects this parameter set
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        executor.submit(_timed_hash, dict(params, time_cost=1)).result()  # Warm up workers
+        for _ in range(rounds):
+            burst_start = time.perf_counter()
+            futures = [executor.submit(_timed_hash, params) for _ in range(concurrency)]
+            for future in as_completed(futures):
+                elapsed, rss = future.result()
+                latencies.append(time.perf_counter() - burst_start)
+                hash_times.append(elapsed)
+                peak_rss = max(peak_rss, rss)
+            total_wall += time.perf_counter() - burst_start
+    
+    return {
+        "iterations": iterations,
+        "memory_mb": memory_mb,
+        "parallelism": parallelism,
+        "hash_ms": round(1000 * sum(hash_times) / len(hash_times), 1),
+        "p50_ms": round(1000 * percentile(latencies, 0.50), 1),
+        "p99_ms": round(1000 * percentile(latencies, 0.99), 1),
+        "throughput": round(len(latencies) / total_wall, 1),
+        "worker_peak_rss_mb": round(peak_rss / 1024, 1),
+        # Authelia hashes every concurrent login at the same time
+        "burst_memory_mb": memory_mb * concurrency
+    }
+
+def config_snippet(result):
+    """
+    Build the configuration.yml password section for a benchmark result
+    """
+    return (
+        "authentication_backend:\n"
+        "  file:\n"
+        "    password:\n"
+        "      algorithm: argon2id\n"
+        f"      iterations: {result['iterations']}\n"
+        f"      salt_length: {ARGON2_DEFAULTS['salt_len']}\n"
+        f"      parallelism: {result['parallelism']}\n"
+        f"      memory: {result['memory_mb']}                   # Memory usage in MB\n"
+    )
+
+def calibrate(concurrency=50, target_p99_ms=1000, rounds=1, workers=None,
+              candidates=None, max_memory_mb=None, print_config=False, as_json=False):
+    """
+    Benchmark Argon2id parameter sets and recommend the strongest one
+    meeting the latency target
+    
+    Args:
+        concurrency (int): Simultaneous logins per burst
+        target_p99_ms (float): Maximum acceptable p99 login latency
+        rounds (int): Bursts per candidate
+        workers (int): Hashing processes (default: CPU count)
+        candidates (list): (iterations, memory_mb, parallelism) tuples
+        max_memory_mb (int): Reject sets whose burst memory exceeds this
+        print_config (bool): Print the configuration.yml snippet
+        as_json (bool): Print machine-readable JSON
+    """
+    if argon2 is None:
+        print("❌ argon2-cffi is required for calibration (pip install argon2-cffi)")
+        return
+    
+    workers = workers or os.cpu_count() or 1
+    candidates = candidates or CALIBRATION_CANDIDATES
+    
+    if not as_json:
+        print(f"⏱️  Simulating {concurrency} simultaneous logins on {workers} worker(s), "
+              f"target p99 {target_p99_ms:.0f} ms")
+        print(f"   {'t':>2} {'mem MB':>7} {'p':>2} {'hash ms':>8} {'p50 ms':>8} "
+              f"{'p99 ms':>8} {'hash/s':>7} {'RSS MB':>7} {'burst MB':>9}")
+    
+    results = []
+    for candidate in candidates:
+        result = benchmark_candidate(candidate, concurrency, workers, rounds)
+        result["meets_target"] = (
+            result["p99_ms"] <= target_p99_ms and
+            (max_memory_mb is None or result["burst_memory_mb"] <= max_memory_mb)
+        )
+        results.append(result)
+        if not as_json:
+            mark = "✅" if result["meets_target"] else "❌"
+            print(f"   {result['iterations']:>2} {result['memory_mb']:>7} {result['parallelism']:>2} "
+                  f"{result['hash_ms']:>8} {result['p50_ms']:>8} {result['p99_ms']:>8} "
+                  f"{result['throughput']:>7} {result['worker_peak_rss_mb']:>7} "
+                  f"{result['burst_memory_mb']:>9} {mark}")
+    
+    # Strongest = most memory-hard work per hash
+    passing = [r for r in results if r["meets_target"]]
+    recommended = max(passing, key=lambda r: (r["iterations"] * r["memory_mb"], r["memory_mb"]),
+                      default=None)
+    
+    if as_json:
+        print(json.dumps({
+            "concurrency": concurrency,
+            "workers": workers,
+            "target_p99_ms": target_p99_ms,
+            "results": results,
+            "recommended": recommended
+        }, indent=2))
+        return
+    
+    print()
+    if not recommended:
+        print("❌ No candidate meets the target; try fewer iterations or less memory")
+        return
+    
+    print(f"🏆 Recommended: iterations={recommended['iterations']}, "
+          f"memory={recommended['memory_mb']} MB, parallelism={recommended['parallelism']} "
+          f"(p99 {recommended['p99_ms']} ms)")
+    if print_config:
         print()
+        print(config_snippet(recommended))
 
 # =============================================================================
 # COMMAND LINE INTERFACE
@@ -291,7 +964,9 @@ def main():
         epilog="Examples:\n"
                "  python3 manage_users.py init\n"
                "  python3 manage_users.py add user@hospital.com password123 --name 'Dr. Smith' --groups doctor\n"
-               "  python3 manage_users.py list\n",
+               "  python3 manage_users.py list\n"
+               "  python3 manage_users.py batch users.csv --dry-run\n"
+               "  python3 manage_users.py calibrate --concurrency 50 --target-p99 500 --print-config\n",
         formatter_class=argparse.RawDescriptionHelpFormatter
     )
     
@@ -322,8 +997,43 @@ def main():
     pwd_parser.add_argument('new_password', help='New password')
     
     # List users command
-    subparsers.add_parser('list', 
-                         help='List all users and their access levels')
+    list_parser = subparsers.add_parser('list', 
+                                       help='List users and their access levels')
+    list_parser.add_argument('--group', help='Only users in this group')
+    list_parser.add_argument('--email', help="Email pattern (e.g. '*@hospital.com')")
+    list_parser.add_argument('--name', help='Display name contains')
+    list_parser.add_argument('--page', type=int, default=1, help='Page number (default: 1)')
+    list_parser.add_argument('--page-size', type=int, default=50,
+                            help='Users per page, 0 for all (default: 50)')
+    list_parser.add_argument('--json', action='store_true', help='Machine-readable JSON output')
+    
+    # Batch command
+    batch_parser = subparsers.add_parser('batch',
+                                        help='Apply a CSV/YAML manifest with a single restart')
+    batch_parser.add_argument('manifest', help='Manifest file (.csv or .yml)')
+    batch_parser.add_argument('--dry-run', action='store_true',
+                             help='Show the changes without applying them')
+    batch_parser.add_argument('--no-restart', action='store_true',
+                             help='Do not restart Authelia after applying')
+    
+    # Argon2 calibration command
+    cal_parser = subparsers.add_parser('calibrate',
+                                      help='Benchmark Argon2id parameters for login latency')
+    cal_parser.add_argument('--concurrency', type=int, default=50,
+                           help='Simultaneous logins to simulate (default: 50)')
+    cal_parser.add_argument('--target-p99', type=float, default=1000,
+                           help='Target p99 login latency in ms (default: 1000)')
+    cal_parser.add_argument('--rounds', type=int, default=1,
+                           help='Login bursts per candidate (default: 1)')
+    cal_parser.add_argument('--workers', type=int, default=None,
+                           help='Hashing processes (default: CPU count)')
+    cal_parser.add_argument('--candidates', type=parse_candidates, default=None,
+                           help="Parameter sets 'iterations:memory_mb:parallelism,...'")
+    cal_parser.add_argument('--max-memory', type=int, default=None,
+                           help='Maximum memory in MB for a full burst of logins')
+    cal_parser.add_argument('--print-config', action='store_true',
+                           help='Print the configuration.yml snippet for the recommendation')
+    cal_parser.add_argument('--json', action='store_true', help='Machine-readable JSON output')
     
     args = parser.parse_args()
     
@@ -331,8 +1041,9 @@ def main():
         parser.print_help()
         return
     
-    print(f"🔧 Authelia User Manager - {args.command.upper()}")
-    print("=" * 50)
+    if not getattr(args, 'json', False):
+        print(f"🔧 Authelia User Manager - {args.command.upper()}")
+        print("=" * 50)
     
     # Execute requested command
     if args.command == 'init':
@@ -348,7 +1059,12 @@ def main():
     elif args.command == 'password':
         change_password(args.email, args.new_password)
     elif args.command == 'list':
-        list_users()
+        list_users(args.group, args.email, args.name, args.page, args.page_size, args.json)
+    elif args.command == 'batch':
+        batch_apply(args.manifest, dry_run=args.dry_run, restart=not args.no_restart)
+    elif args.command == 'calibrate':
+        calibrate(args.concurrency, args.target_p99, args.rounds, args.workers,
+                  args.candidates, args.max_memory, args.print_config, args.json)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file